@@ -0,0 +1,128 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+# Concurrency stress test of repository.book: hundreds of threads, spread over several processes
+# like several bot processes sharing the database, book random overlapping times of the same
+# machine at the same moment. Afterwards no two stored bookings may overlap or come closer than
+# the buffer, and every booking reported as made must be stored. Then an overlapping row is
+# inserted past repository.book, which the overlap trigger has to reject.
+#
+# python3 bench/booking_stress.py --threads 100 --processes 4 --rounds 5
+# exits with 1 when a double booking is found.
+
+# All bookings go into this window, a few hours wide, so nearly every attempt conflicts with another one
+WINDOW_START = datetime.now().replace(hour=10, minute=0, second=0, microsecond=0) + timedelta(days=1)
+WINDOW_SLOTS = 24
+
+
+def book_concurrently(process: int, threads: int, rounds: int, seed: int, start_at: float):
+    """Runs in a worker process, returns the (booking_id, start, end) it was told were booked."""
+    import repository
+    from houses import HOUSES
+    from slot_cache import BUFFER
+
+    house = next(iter(HOUSES.values()))
+    resource = house.resources[0]
+    booked = []
+    booked_lock = threading.Lock()
+    barrier = threading.Barrier(threads)
+
+    def attempt(thread: int) -> None:
+        rng = random.Random(seed * 1_000_003 + process * 1000 + thread)
+        # Every thread is ready before the first booking, the processes start at the same moment
+        barrier.wait()
+        time.sleep(max(0.0, start_at - time.time()))
+        for _ in range(rounds):
+            start = WINDOW_START + timedelta(minutes=15 * rng.randrange(WINDOW_SLOTS))
+            end = start + timedelta(minutes=rng.choice((30, 60, 90)))
+            booking_id = repository.book(house.id, resource.id, 1_000_000 + thread, start, end, BUFFER)
+            if booking_id is not None:
+                with booked_lock:
+                    booked.append((booking_id, start, end))
+
+    workers = [threading.Thread(target=attempt, args=(thread,)) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return booked
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=100, help='booking threads per process')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=5, help='bookings each thread attempts')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # A throwaway database with the default house, inherited by the worker processes
+    os.chdir(tempfile.mkdtemp(prefix='booking_bot_stress_'))
+    os.environ['DB_PATH'] = 'bookings.db'
+    os.environ['HOUSES_FILE'] = 'houses.json'
+    os.environ['DB_POOL_SIZE'] = str(args.threads)
+
+    import repository
+    from houses import HOUSES
+    from schema import from_ts
+    from slot_cache import BUFFER
+
+    house = next(iter(HOUSES.values()))
+    resource = house.resources[0]
+    # Creates and migrates the database once, before the processes race for it
+    repository.house_pool(house.id)
+
+    attempts = args.threads * args.processes * args.rounds
+    start_at = time.time() + 2
+    with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+        results = pool.starmap(book_concurrently, [(process, args.threads, args.rounds, args.seed, start_at)
+                                                   for process in range(args.processes)])
+    elapsed = time.time() - start_at
+    reported = sorted(booking for booked in results for booking in booked)
+    print(f"{attempts} booking attempts from {args.threads * args.processes} threads in {args.processes} processes "
+          f"in {elapsed:.2f} s, {len(reported)} succeeded")
+
+    window_end = WINDOW_START + timedelta(minutes=15 * WINDOW_SLOTS + 90)
+    stored = [(from_ts(start_ts), from_ts(end_ts)) for start_ts, end_ts
+              in repository.bookings_in_window(house.id, resource.id, WINDOW_START, window_end, BUFFER)]
+    failures = []
+    if len(stored) != len(reported):
+        failures.append(f"{len(reported)} bookings reported as made, but {len(stored)} stored")
+    for (start, end), (next_start, next_end) in zip(stored, stored[1:]):
+        if next_start < end:
+            failures.append(f"double booking: {start:%H:%M}-{end:%H:%M} and {next_start:%H:%M}-{next_end:%H:%M}")
+        elif next_start < end + BUFFER:
+            failures.append(f"less than {BUFFER} between {start:%H:%M}-{end:%H:%M} and {next_start:%H:%M}-{next_end:%H:%M}")
+    print(f"{len(stored)} bookings stored, {len(failures)} overlapping")
+
+    # The trigger is the safety net for writers that don't go through repository.book
+    start, end = stored[0]
+    conn = sqlite3.connect(house.db_path)
+    try:
+        conn.execute("INSERT INTO bookings (user_id, resource_id, start_booking_date, end_booking_date, start_time, "
+                     "end_time, start_ts, end_ts) VALUES (?, ?, '', '', '', '', ?, ?)",
+                     (1, resource.id, f'{start:%Y-%m-%d %H:%M}', f'{end:%Y-%m-%d %H:%M}'))
+        conn.commit()
+        failures.append("the overlap trigger let a direct insert of a taken time through")
+    except sqlite3.IntegrityError:
+        print("overlapping direct insert rejected by the trigger")
+    conn.close()
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for the Telegram Bot API, used by the benchmarks.
+# It answers the methods the bot uses, enforces flood limits like Telegram does
+# (429 with retry_after) and counts every call, so runs are offline and reproducible.
+
+# Flood limits enforced by the fake: messages per rolling second, globally and per chat
+GLOBAL_LIMIT = 30
+CHAT_LIMIT = 3
+
+
+class FakeTelegram:
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 global_limit: int = GLOBAL_LIMIT, chat_limit: int = CHAT_LIMIT, poll_wait: float = 0.5):
+        self.latency = latency
+        # getUpdates has no updates to return, it waits at most this long like a long poll
+        self.poll_wait = poll_wait
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self.calls = Counter()
+        self.messages = defaultdict(list)
+        self.rate_limited = 0
+        # chat_id -> inline keyboard of the last edited message, the buttons a user sees
+        self.keyboards = {}
+        # chat_ids getChat knows no username of, and the ones it doesn't know at all
+        self.no_username = set()
+        self.unknown_chats = set()
+        # (time.monotonic(), method, params) of every call, for latency measurements
+        self.log = []
+        self._sent = deque()
+        self._sent_per_chat = defaultdict(deque)
+        self._message_ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                self._answer(*fake.handle(url.path.rsplit('/', 1)[-1], params))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                params = json.loads(body) if body else {}
+                self._answer(*fake.handle(urlparse(self.path).path.rsplit('/', 1)[-1], params))
+
+            def _answer(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 1024
+
+        self.server = Server((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def base_url(self) -> str:
+        # For telegram.Bot(token, base_url=...), which appends the token itself
+        return f'{self.url}/bot'
+
+    def start(self) -> 'FakeTelegram':
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _over_limit(self, chat_id, now: float) -> bool:
+        for window, limit in ((self._sent, self.global_limit), (self._sent_per_chat[chat_id], self.chat_limit)):
+            while window and now - window[0] >= 1:
+                window.popleft()
+            if len(window) >= limit:
+                return True
+        self._sent.append(now)
+        self._sent_per_chat[chat_id].append(now)
+        return False
+
+    def handle(self, method: str, params: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getUpdates':
+            with self._lock:
+                self.calls[method] += 1
+                self.log.append((time.monotonic(), method, params))
+            time.sleep(min(float(params.get('timeout') or 0), self.poll_wait))
+            return 200, {'ok': True, 'result': []}
+        with self._lock:
+            self.calls[method] += 1
+            self.log.append((time.monotonic(), method, params))
+            if method == 'getMe':
+                return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+            if method == 'getChat':
+                chat_id = int(params['chat_id'])
+                if chat_id in self.unknown_chats:
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}
+                chat = {'id': chat_id, 'type': 'private'}
+                if chat_id not in self.no_username:
+                    chat['username'] = f'user{chat_id}'
+                return 200, {'ok': True, 'result': chat}
+            if method in ('sendMessage', 'editMessageText'):
+                chat_id = int(params.get('chat_id', 0))
+                if method == 'sendMessage' and self._over_limit(chat_id, time.monotonic()):
+                    self.rate_limited += 1
+                    return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                 'parameters': {'retry_after': 1}}
+                self.messages[chat_id].append(params.get('text'))
+                if method == 'editMessageText':
+                    markup = params.get('reply_markup')
+                    self.keyboards[chat_id] = json.loads(markup) if isinstance(markup, str) else markup
+                return 200, {'ok': True, 'result': {
+                    'message_id': next(self._message_ids), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', ''),
+                }}
+            if method in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+                return 200, {'ok': True, 'result': True}
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+
+def synthetic_updates(count: int, users: int):
+    """Callback queries pressing the menu, date and 'my bookings' buttons, as Telegram would send them.
+
+    Each of them makes the bot edit the pressed message exactly once, its message_id is the update_id.
+    """
+    dates = [(datetime.now() + timedelta(days=i)).strftime('%d.%m.%Y') for i in range(7)]
+    buttons = ['1', '3'] + [f'date_{date}' for date in dates]
+    for number in range(1, count + 1):
+        user_id = number % users + 1
+        yield {
+            'update_id': number,
+            'callback_query': {
+                'id': str(number),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'},
+                'chat_instance': str(user_id),
+                'data': buttons[number % len(buttons)],
+                'message': {'message_id': number, 'date': 0, 'text': 'Пожалуйста, выбери:',
+                            'chat': {'id': user_id, 'type': 'private'}},
+            },
+        }
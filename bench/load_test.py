@@ -0,0 +1,256 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# Load test of the real handlers: a database pre-filled with a year of bookings, a local fake
+# Bot API, and thousands of synthetic users that each go through the whole conversation,
+# /start, the menu, a date, typing a time (some of them too long, so they have to confirm),
+# their bookings, cancelling one, and now and then the list of all bookings.
+# Every update is handled synchronously by Dispatcher.process_update on one of the client
+# threads, so its latency is the time the handlers take, including the DB and the Bot API
+# calls they wait for; what goes through the outbox is sent in the background as in the bot.
+#
+# python3 bench/load_test.py --users 2000 --clients 16 --max-p99-ms 250 --report load.json
+# exits with 1 when a threshold is missed, so it can gate a deploy.
+
+from fake_telegram import FakeTelegram
+
+SCENARIO_STEPS = ['start', 'menu', 'house', 'resource', 'date', 'book_time', 'confirm_booking',
+                  'view_bookings', 'cancel_time', 'delete_booking', 'display_all_bookings']
+
+
+def write_houses(path: str, houses: int, resources: int, retention_days: int) -> None:
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump([{'id': f'h{house}', 'name': f'Дом {house}', 'retention_days': retention_days,
+                    'resources': [{'id': f'm{resource}', 'name': f'Машина {resource}'} for resource in range(resources)]}
+                   for house in range(houses)], file, ensure_ascii=False)
+
+
+def prefill(repository, houses, days: int, per_day: int, residents: int, rng: random.Random) -> int:
+    """Books up to per_day random slots of every resource on each of the last days, and half as many
+    on the next week, through repository.book like the bot does. Returns how many were booked."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    booked = 0
+    for house in houses.values():
+        for resource in house.resources:
+            for offset in range(-days, 7):
+                day = today + timedelta(days=offset)
+                wanted = per_day if offset < 0 else per_day // 2
+                placed = 0
+                for _ in range(wanted * 3):
+                    if placed == wanted:
+                        break
+                    start = day + timedelta(minutes=30 * rng.randrange(12, 44))
+                    end = start + timedelta(minutes=rng.choice((60, 90, 120)))
+                    user_id = 1_000_000 + rng.randrange(residents)
+                    if repository.book(house.id, resource.id, user_id, start, end, timedelta(minutes=30)) is not None:
+                        placed += 1
+                booked += placed
+    return booked
+
+
+class Client:
+    """Builds the updates a user sends, as Telegram would deliver them."""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id: int):
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user{user_id}'}
+        self.chat = {'id': user_id, 'type': 'private'}
+
+    def message(self, text: str) -> dict:
+        number = next(self._update_ids)
+        message = {'message_id': number, 'date': int(time.time()), 'chat': self.chat, 'from': self.user, 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': number, 'message': message}
+
+    def press(self, data: str) -> dict:
+        number = next(self._update_ids)
+        return {'update_id': number, 'callback_query': {
+            'id': str(number), 'from': self.user, 'chat_instance': str(self.user['id']), 'data': data,
+            'message': {'message_id': number, 'date': 0, 'text': 'Пожалуйста, выбери:', 'chat': self.chat},
+        }}
+
+
+def percentile(values, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000, help='synthetic users, each runs the scenario once')
+    parser.add_argument('--clients', type=int, default=16, help='users served concurrently')
+    parser.add_argument('--houses', type=int, default=2)
+    parser.add_argument('--resources', type=int, default=2, help='machines per house')
+    parser.add_argument('--days', type=int, default=365, help='days of booking history to pre-fill')
+    parser.add_argument('--per-day', type=int, default=8, help='pre-filled bookings per machine and day')
+    parser.add_argument('--residents', type=int, default=500, help='distinct users of the pre-filled bookings')
+    parser.add_argument('--confirm-share', type=float, default=0.2, help='share of users booking more than 3 hours')
+    parser.add_argument('--all-share', type=float, default=0.2, help='share of users listing all bookings')
+    parser.add_argument('--latency', type=float, default=0.01, help='simulated Bot API latency, in seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--report', help='write the results as JSON to this file')
+    parser.add_argument('--max-p99-ms', type=float, help='fail if the p99 latency of any step is higher')
+    parser.add_argument('--min-throughput', type=float, help='fail if fewer updates per second are handled')
+    args = parser.parse_args()
+    if args.report:
+        args.report = os.path.abspath(args.report)
+
+    # No flood limits, only the handlers are measured
+    fake = FakeTelegram(latency=args.latency, global_limit=10 ** 9, chat_limit=10 ** 9).start()
+
+    # A throwaway working directory with its own houses, before the bot modules read the config.
+    # The getChat lookups go to the fake too, and the outbox isn't throttled.
+    os.chdir(tempfile.mkdtemp(prefix='booking_bot_load_'))
+    os.environ['BOT_TOKEN'] = '123:fake'
+    os.environ['TELEGRAM_API_URL'] = fake.url
+    os.environ['DB_PATH'] = 'bookings.db'
+    os.environ['HOUSES_FILE'] = 'houses.json'
+    os.environ['OUTBOX_GLOBAL_RATE'] = os.environ['OUTBOX_CHAT_RATE'] = '1000000'
+    write_houses('houses.json', args.houses, args.resources, args.days + 1)
+
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher
+    from telegram.utils.request import Request
+
+    import repository
+    import book_the_time_slot
+    from houses import HOUSES
+    from sessions import SessionPersistence
+    from metrics import DB_LOCK_WAIT_SECONDS, DB_POOL_WAIT_SECONDS, DB_SECONDS
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rng = random.Random(args.seed)
+
+    started = time.monotonic()
+    booked = prefill(repository, HOUSES, args.days, args.per_day, args.residents, rng)
+    print(f"pre-filled {booked} bookings in {len(HOUSES)} houses in {time.monotonic() - started:.1f} s")
+
+    bot = Bot('123:fake', base_url=fake.base_url, request=Request(con_pool_size=args.clients + 8))
+    book_the_time_slot.outbox.start(bot)
+    book_the_time_slot.scheduler.start()
+
+    persistence = SessionPersistence()
+    dispatcher = Dispatcher(bot, Queue(), workers=1, use_context=True, persistence=persistence)
+    book_the_time_slot.register_handlers(dispatcher, run_async=False)
+    errors = []
+    dispatcher.add_error_handler(lambda update, context: errors.append(repr(context.error)))
+
+    latencies = defaultdict(list)
+    latencies_lock = threading.Lock()
+    dates = [(datetime.now() + timedelta(days=offset)).strftime('%d.%m.%Y') for offset in range(1, 7)]
+
+    def send(step: str, data: dict) -> None:
+        update = Update.de_json(data, bot)
+        handling = time.perf_counter()
+        dispatcher.process_update(update)
+        elapsed = (time.perf_counter() - handling) * 1000
+        with latencies_lock:
+            latencies[step].append(elapsed)
+
+    def scenario(user_id: int) -> None:
+        # Seeded per user, so the choices don't depend on the order the clients run in
+        choices = random.Random(args.seed * 1_000_003 + user_id)
+        client = Client(user_id)
+        send('start', client.message('/start'))
+        send('menu', client.press('1'))
+        house = choices.choice(list(HOUSES.values()))
+        if len(HOUSES) > 1:
+            send('house', client.press(f'house_{house.id}'))
+        if len(house.resources) > 1:
+            send('resource', client.press(f'resource_{choices.choice(house.resources).id}'))
+        send('date', client.press(f'date_{choices.choice(dates)}'))
+
+        start = datetime(2000, 1, 1) + timedelta(minutes=30 * choices.randrange(12, 40))
+        if choices.random() < args.confirm_share:
+            end = start + timedelta(hours=4)
+            send('book_time', client.message(f'{start:%H:%M}-{end:%H:%M}'))
+            send('confirm_booking', client.press('confirm_yes'))
+        else:
+            end = start + timedelta(minutes=choices.choice((60, 90, 120)))
+            send('book_time', client.message(f'{start:%H:%M}-{end:%H:%M}'))
+
+        send('view_bookings', client.press('3'))
+        send('cancel_time', client.press('2'))
+        # Cancel a booking from the buttons the bot just showed, half of the time
+        keyboard = (fake.keyboards.get(user_id) or {}).get('inline_keyboard', [])
+        buttons = [row[0]['callback_data'] for row in keyboard if row[0]['callback_data'].startswith('cancel_')]
+        if buttons and choices.random() < 0.5:
+            send('delete_booking', client.press(buttons[0]))
+        if choices.random() < args.all_share:
+            send('display_all_bookings', client.press('4'))
+
+    db_before = DB_SECONDS.totals()
+    lock_before = DB_LOCK_WAIT_SECONDS.totals()
+    pool_before = DB_POOL_WAIT_SECONDS.totals()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        list(clients.map(scenario, range(1, args.users + 1)))
+    elapsed = time.monotonic() - started
+
+    def spent(histogram, before) -> tuple:
+        after = histogram.totals()
+        count = sum(after[label][0] - before.get(label, (0, 0))[0] for label in after)
+        total = sum(after[label][1] - before.get(label, (0, 0))[1] for label in after)
+        return count, total
+
+    updates = sum(len(values) for values in latencies.values())
+    results = {'updates': updates, 'seconds': elapsed, 'throughput': updates / elapsed, 'errors': errors,
+               'prefilled_bookings': booked, 'steps': {}}
+    print(f"{args.users} users, {updates} updates in {elapsed:.2f} s, {updates / elapsed:.1f} updates/s, "
+          f"{len(errors)} errors")
+    print(f"{'step':>22} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for step in SCENARIO_STEPS:
+        values = sorted(latencies.get(step, []))
+        if not values:
+            continue
+        results['steps'][step] = {'count': len(values), 'p50_ms': statistics.median(values),
+                                  'p99_ms': percentile(values, 0.99), 'max_ms': values[-1]}
+        print(f"{step:>22} {len(values):6} {statistics.median(values):8.1f} {percentile(values, 0.99):8.1f} "
+              f"{values[-1]:8.1f}")
+
+    for name, histogram, before in (('db', DB_SECONDS, db_before), ('db_lock_wait', DB_LOCK_WAIT_SECONDS, lock_before),
+                                    ('db_pool_wait', DB_POOL_WAIT_SECONDS, pool_before)):
+        count, total = spent(histogram, before)
+        results[f'{name}_seconds'] = total
+        print(f"{name}: {count} waits/calls, {total:.2f} s in total, {total / count * 1000 if count else 0:.2f} ms mean")
+    results['telegram_calls'] = dict(fake.calls)
+    print(f"Bot API calls: {dict(fake.calls)}, {book_the_time_slot.outbox.queue_size()} messages still queued")
+
+    persistence.flush()
+    fake.stop()
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2, default=str)
+
+    failures = []
+    if errors:
+        failures.append(f"{len(errors)} handler errors, first: {errors[0]}")
+    if args.max_p99_ms is not None:
+        failures += [f"{step} p99 {step_result['p99_ms']:.1f} ms > {args.max_p99_ms} ms"
+                     for step, step_result in results['steps'].items() if step_result['p99_ms'] > args.max_p99_ms]
+    if args.min_throughput is not None and results['throughput'] < args.min_throughput:
+        failures.append(f"{results['throughput']:.1f} updates/s < {args.min_throughput}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
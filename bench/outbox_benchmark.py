@@ -0,0 +1,47 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from fake_telegram import FakeTelegram
+from outbox import Outbox
+
+# Sends a burst of messages through the Outbox to the fake Bot API and reports
+# the throughput and whether the flood limits were respected (no 429 answers).
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated Bot API latency, in seconds')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency).start()
+    outbox = Outbox(workers=args.workers)
+    outbox.start(Bot('123:fake', base_url=fake.base_url, request=Request(con_pool_size=args.workers + 1)))
+
+    started = time.monotonic()
+    for number in range(args.messages):
+        outbox.send_message(number % args.chats + 1, f'Напоминание #{number}')
+    enqueued = time.monotonic() - started
+    outbox.stop()
+    elapsed = time.monotonic() - started
+    fake.stop()
+
+    metrics = outbox.metrics()
+    print(f"enqueued {args.messages} messages in {enqueued * 1000:.1f} ms")
+    print(f"delivered {metrics.get('sent', 0)} in {elapsed:.2f} s, {metrics.get('sent', 0) / elapsed:.1f} msg/s")
+    print(f"mean queue latency {metrics.get('latency_seconds', 0) / args.messages * 1000:.1f} ms")
+    print(f"failed {metrics.get('failed', 0)}, retried {metrics.get('retried', 0)}, "
+          f"429 answers from the fake API {fake.rate_limited}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# Replays updates against the webhook mode at a high rate and measures the end-to-end
+# latency from posting an update to the bot's answer at the fake Bot API, and the throughput.
+# The updates are read from a JSON-lines file of recorded updates, or synthesized.
+# Only callback queries are timed: their answer is the edit of the pressed message.
+
+os.chdir(tempfile.mkdtemp(prefix='booking_bot_bench_'))
+os.environ.setdefault('DB_PATH', 'bookings.db')
+
+from telegram import Bot
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+from fake_telegram import FakeTelegram, synthetic_updates
+from webhook import WebhookServer, SECRET_HEADER
+import book_the_time_slot
+
+SECRET = 'replay-secret'
+
+
+def load_updates(path: str):
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', help='JSON-lines file with recorded updates, synthesized if omitted')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent HTTP connections posting updates')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated Bot API latency, in seconds')
+    args = parser.parse_args()
+
+    updates = load_updates(args.file) if args.file else list(synthetic_updates(args.updates, args.users))
+    timed = {update['update_id']: update['callback_query']['message']['message_id']
+             for update in updates if 'callback_query' in update}
+
+    fake = FakeTelegram(latency=args.latency, global_limit=10 ** 9, chat_limit=10 ** 9).start()
+    bot = Bot('123:fake', base_url=fake.base_url, request=Request(con_pool_size=args.workers * 2 + 8))
+    book_the_time_slot.outbox.start(bot)
+
+    dispatcher = Dispatcher(bot, Queue(), workers=args.workers, use_context=True)
+    book_the_time_slot.register_handlers(dispatcher, run_async=True)
+    webhook = WebhookServer(dispatcher, port=0, secret_token=SECRET, workers=args.workers)
+    webhook.start()
+
+    posted_at = {}
+    statuses = []
+    local = threading.local()
+
+    def post(update) -> None:
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', webhook.port)
+        body = json.dumps(update).encode()
+        posted_at[update['update_id']] = time.monotonic()
+        while True:
+            local.connection.request('POST', webhook.path, body,
+                                     {'Content-Type': 'application/json', SECRET_HEADER: SECRET})
+            response = local.connection.getresponse()
+            response.read()
+            statuses.append(response.status)
+            if response.status != 503:
+                return
+            # Backpressure, Telegram would redeliver the update later
+            time.sleep(0.05)
+
+    del fake.log[:]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        list(clients.map(post, updates))
+    posting = time.monotonic() - started
+
+    while fake.calls['editMessageText'] < len(timed):
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    edited_at = {int(params['message_id']): at for at, method, params in fake.log if method == 'editMessageText'}
+    latencies = sorted((edited_at[message_id] - posted_at[update_id]) * 1000 for update_id, message_id in timed.items())
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    print(f"posted {len(updates)} updates in {posting:.2f} s ({len(updates) / posting:.1f}/s), "
+          f"answers: {dict((status, statuses.count(status)) for status in set(statuses))}")
+    print(f"handled in {elapsed:.2f} s, {len(updates) / elapsed:.1f} updates/s")
+    print(f"end-to-end latency p50 {statistics.median(latencies):.1f} ms, p99 {p99:.1f} ms")
+
+    webhook.stop()
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# Compares the 'threaded' and 'async' runtimes (BOT_RUNTIME) on a synthetic stream of
+# callback queries. Every update ends with exactly one editMessageText call to the fake
+# Bot API, which is how the end-to-end latency of each update is measured.
+
+# Work on a throwaway database, before the bot modules read the config
+os.chdir(tempfile.mkdtemp(prefix='booking_bot_bench_'))
+os.environ.setdefault('DB_PATH', 'bookings.db')
+
+from telegram import Bot, Update
+from telegram.utils.request import Request
+from telegram.ext import Dispatcher
+
+from fake_telegram import FakeTelegram, synthetic_updates
+import book_the_time_slot
+
+
+def run(mode: str, fake: FakeTelegram, bot: Bot, count: int, users: int, workers: int) -> None:
+    dispatcher = Dispatcher(bot, Queue(), workers=workers, use_context=True)
+    book_the_time_slot.register_handlers(dispatcher, run_async=mode == 'async')
+    thread = threading.Thread(target=dispatcher.start, name=f'dispatcher-{mode}', daemon=True)
+    thread.start()
+
+    del fake.log[:]
+    edits_before = fake.calls['editMessageText']
+    sent_at = {}
+    started = time.monotonic()
+    for data in synthetic_updates(count, users):
+        sent_at[data['update_id']] = time.monotonic()
+        dispatcher.update_queue.put(Update.de_json(data, bot))
+
+    while fake.calls['editMessageText'] - edits_before < count:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+    dispatcher.stop()
+    thread.join()
+
+    latencies = sorted((at - sent_at[int(params['message_id'])]) * 1000
+                       for at, method, params in fake.log if method == 'editMessageText')
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{mode:>8}: {count / elapsed:7.1f} updates/s, p50 {statistics.median(latencies):7.1f} ms, p99 {p99:7.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated Bot API latency, in seconds')
+    args = parser.parse_args()
+
+    # No flood limits here, only the handlers are measured
+    fake = FakeTelegram(latency=args.latency, global_limit=10 ** 9, chat_limit=10 ** 9).start()
+    # One HTTP connection per thread that talks to the API, like Updater does
+    bot = Bot('123:fake', base_url=fake.base_url, request=Request(con_pool_size=args.workers + 8))
+    book_the_time_slot.outbox.start(bot)
+
+    for mode in ('threaded', 'async'):
+        run(mode, fake, bot, args.updates, args.users, args.workers)
+
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+# Cold start of the bot process: starts book_the_time_slot.py against the fake Bot API and a
+# pre-filled database, and measures how long it takes until it polls for updates, and how long
+# it takes to exit after SIGTERM, which is what a supervisor waits for on every restart.
+#
+# python3 bench/startup_benchmark.py --runs 5 --importtime
+
+from fake_telegram import FakeTelegram
+
+
+def wait_for(predicate, process, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        if process.poll() is not None:
+            return False
+        time.sleep(0.001)
+    return False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--days', type=int, default=365, help='days of booking history to pre-fill')
+    parser.add_argument('--per-day', type=int, default=8, help='pre-filled bookings per day')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--importtime', action='store_true', help='also show the slowest imports')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(global_limit=10 ** 9, chat_limit=10 ** 9, poll_wait=0.1).start()
+    workdir = tempfile.mkdtemp(prefix='booking_bot_startup_')
+    os.chdir(workdir)
+    env = dict(os.environ, BOT_TOKEN='123:fake', TELEGRAM_API_URL=fake.url, DB_PATH='bookings.db',
+               HOUSES_FILE='houses.json', METRICS_PORT='0', BOT_MODE='polling')
+    os.environ.update(env)
+
+    # Pre-fill in this process, the bot processes then only open an existing database
+    import repository
+    from houses import HOUSES
+    from load_test import prefill
+    booked = prefill(repository, HOUSES, args.days, args.per_day, 500, random.Random(1))
+    repository.get_pool().close()
+    print(f"pre-filled {booked} bookings")
+
+    ready, stopped = [], []
+    for run in range(args.runs):
+        polls = fake.calls['getUpdates']
+        with open(os.path.join(workdir, f'run{run}.log'), 'w') as log:
+            started = time.monotonic()
+            process = subprocess.Popen([sys.executable, os.path.join(SRC, 'book_the_time_slot.py')],
+                                       env=env, stdout=log, stderr=subprocess.STDOUT)
+            if not wait_for(lambda: fake.calls['getUpdates'] > polls, process, args.timeout):
+                process.kill()
+                sys.exit(f"the bot didn't start polling, see {log.name}")
+            ready.append(time.monotonic() - started)
+
+            stopping = time.monotonic()
+            process.send_signal(signal.SIGTERM)
+            process.wait(args.timeout)
+            stopped.append(time.monotonic() - stopping)
+            if process.returncode != 0:
+                # Killed by the signal instead of stopping, the stop time means nothing
+                sys.exit(f"the bot exited with {process.returncode}, see {log.name}")
+        print(f"run {run + 1}: polling after {ready[-1] * 1000:.0f} ms, exited {stopped[-1] * 1000:.0f} ms after SIGTERM")
+
+    print(f"start: median {statistics.median(ready) * 1000:.0f} ms, max {max(ready) * 1000:.0f} ms")
+    print(f"stop: median {statistics.median(stopped) * 1000:.0f} ms, max {max(stopped) * 1000:.0f} ms")
+
+    if args.importtime:
+        # python -X importtime prints 'import time: self | cumulative | module' per import
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import book_the_time_slot'],
+                                env=dict(env, PYTHONPATH=SRC), capture_output=True, text=True)
+        imports = []
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line and 'self' not in line:
+                _, cumulative, module = line[len('import time:'):].split('|')
+                imports.append((int(cumulative), module.rstrip()))
+        print("slowest imports (cumulative, ms):")
+        for cumulative, module in sorted(imports, reverse=True)[:15]:
+            print(f"{cumulative / 1000:8.1f} {module}")
+
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
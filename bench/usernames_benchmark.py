@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# Checks the username cache against the fake Bot API: a cold list view looks every user up once,
+# users without a username or unknown to getChat included, the next views make no getChat calls
+# at all, and many expired entries at once are refreshed in the background without blocking the
+# lookups of new users.
+#
+# python3 bench/usernames_benchmark.py --users 200
+# exits with 1 when one of the checks fails.
+
+from fake_telegram import FakeTelegram
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--stale-views', type=int, default=16, help='list views with expired names at once')
+    parser.add_argument('--latency', type=float, default=0.2, help='simulated Bot API latency, in seconds')
+    parser.add_argument('--timeout', type=float, default=10)
+    args = parser.parse_args()
+
+    fake = FakeTelegram().start()
+    os.chdir(tempfile.mkdtemp(prefix='booking_bot_usernames_'))
+    os.environ['BOT_TOKEN'] = '123:fake'
+    os.environ['TELEGRAM_API_URL'] = fake.url
+    os.environ['DB_PATH'] = 'bookings.db'
+
+    import repository
+    import usernames
+
+    user_ids = [str(user_id) for user_id in range(1, args.users + 1)]
+    # Every fifth user has no username, every seventh is unknown to getChat
+    fake.no_username.update(int(user_id) for user_id in user_ids if int(user_id) % 5 == 0)
+    fake.unknown_chats.update(int(user_id) for user_id in user_ids if int(user_id) % 7 == 0)
+    failures = []
+
+    def view(ids):
+        calls = fake.calls['getChat']
+        started = time.monotonic()
+        names = usernames.get_usernames(ids)
+        return names, fake.calls['getChat'] - calls, time.monotonic() - started
+
+    names, calls, elapsed = view(user_ids)
+    print(f"cold view: {calls} getChat calls in {elapsed * 1000:.0f} ms")
+    if calls != len(user_ids):
+        failures.append(f"cold view made {calls} getChat calls, expected {len(user_ids)}")
+    wrong = [user_id for user_id in user_ids
+             if names[user_id] != (None if int(user_id) in fake.no_username | fake.unknown_chats else f'user{user_id}')]
+    if wrong:
+        failures.append(f"{len(wrong)} wrong usernames, first: {wrong[0]}")
+
+    _, calls, elapsed = view(user_ids)
+    print(f"warm view: {calls} getChat calls in {elapsed * 1000:.0f} ms")
+    if calls:
+        failures.append(f"warm view made {calls} getChat calls, expected 0")
+
+    # Expire everyone, then let getChat fail for a known user: they keep their name
+    fake.latency = args.latency
+    fake.unknown_chats.add(1)
+    expired = datetime.now() - usernames.USERNAME_TTL - timedelta(minutes=1)
+    repository.save_usernames(names, expired)
+    chunk = max(1, len(user_ids) // args.stale_views)
+    views = [threading.Thread(target=view, args=(user_ids[i:i + chunk],)) for i in range(0, len(user_ids), chunk)]
+    started = time.monotonic()
+    for thread in views:
+        thread.start()
+    for thread in views:
+        thread.join()
+    print(f"{len(views)} views with expired names answered in {(time.monotonic() - started) * 1000:.0f} ms")
+
+    # A new user is looked up while the refreshes are still running
+    lookup = threading.Thread(target=view, args=([str(args.users + 1)],), daemon=True)
+    started = time.monotonic()
+    lookup.start()
+    lookup.join(args.timeout)
+    if lookup.is_alive():
+        failures.append(f"the lookup of a new user was blocked for {args.timeout} s by the background refreshes")
+    else:
+        print(f"new user looked up in {(time.monotonic() - started) * 1000:.0f} ms during the refreshes")
+
+    deadline = time.monotonic() + args.timeout
+    while usernames._refreshing and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if usernames._refreshing:
+        failures.append(f"{len(usernames._refreshing)} refreshes didn't finish in {args.timeout} s")
+    fake.latency = 0
+    names, calls, _ = view(user_ids)
+    print(f"after the refresh: {calls} getChat calls")
+    if calls:
+        failures.append(f"view after the refresh made {calls} getChat calls, expected 0")
+    if names['1'] != 'user1':
+        failures.append(f"a failed refresh lost the username of user 1: {names['1']!r}")
+
+    fake.stop()
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import csv
+import io
+import sys
+from datetime import datetime, timedelta
+from html import escape
+
+import repository
+from houses import HOUSES
+
+# Reports are computed from the usage_hourly and usage_daily aggregates, which are updated
+# with every booking and cancellation, so a report over a year costs a few thousand rows
+# per resource, grouped in SQLite, instead of a scan over the bookings and the archive.
+
+WEEKDAYS = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+# Occupancy from 0 to 100% as one character of the heatmap
+SHADES = ' ░▒▓█'
+
+
+def report_window(days: int, now: datetime = None):
+    # Whole days up to and including today
+    until = (now or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return until - timedelta(days=days), until
+
+
+def hours_available(since: datetime, until: datetime):
+    """How often each (weekday, hour) occurs in [since, until), both at midnight, weekday 0 is Monday."""
+    counts = [0] * 7
+    day = since
+    while day < until:
+        counts[day.weekday()] += 1
+        day += timedelta(days=1)
+    return counts
+
+
+def occupancy(house_id: str, since: datetime, until: datetime):
+    """7x24 matrix (Monday first) of the share of the house's machine time that was booked."""
+    house = HOUSES[house_id]
+    days = hours_available(since, until)
+    matrix = [[0.0] * 24 for _ in range(7)]
+    for sqlite_weekday, hour, minutes in repository.usage_by_weekday_hour(house_id, since, until):
+        weekday = (sqlite_weekday + 6) % 7
+        if days[weekday]:
+            matrix[weekday][hour] = minutes / (days[weekday] * 60 * len(house.resources))
+    return matrix
+
+
+def report(house_id: str, days: int, now: datetime = None) -> dict:
+    since, until = report_window(days, now)
+    matrix = occupancy(house_id, since, until)
+    booked, cancelled = repository.usage_counts(house_id, since, until)
+    cells = [(share, weekday, hour) for weekday, row in enumerate(matrix) for hour, share in enumerate(row)]
+    return {
+        'since': since,
+        'until': until,
+        'booked': booked,
+        'cancelled': cancelled,
+        'cancel_rate': cancelled / booked if booked else 0.0,
+        'occupancy': matrix,
+        'average_occupancy': sum(share for share, _, _ in cells) / len(cells),
+        'peaks': sorted((cell for cell in cells if cell[0] > 0), reverse=True)[:5],
+    }
+
+
+def render_heatmap(matrix) -> str:
+    lines = ['   ' + ''.join(f'{hour:<6}' for hour in range(0, 24, 6))]
+    for weekday, row in enumerate(matrix):
+        shades = ''.join(SHADES[min(len(SHADES) - 1, round(share * (len(SHADES) - 1)))] for share in row)
+        lines.append(f'{WEEKDAYS[weekday]} {shades}')
+    return '\n'.join(lines)
+
+
+def render_report(house_id: str, data: dict) -> str:
+    """The report as an HTML message for the admin command."""
+    house = HOUSES[house_id]
+    peaks = ', '.join(f'{WEEKDAYS[weekday]} {hour:02d}:00 {share:.0%}' for share, weekday, hour in data['peaks'])
+    return (f"<b>{escape(house.name)}</b>, {data['since']:%d.%m.%Y} - {data['until'] - timedelta(days=1):%d.%m.%Y}\n"
+            f"Бронирований: {data['booked']}, отмен: {data['cancelled']} ({data['cancel_rate']:.0%})\n"
+            f"Средняя загрузка: {data['average_occupancy']:.0%}\n"
+            f"Пиковые часы: {peaks or '-'}\n"
+            f"<pre>{render_heatmap(data['occupancy'])}</pre>")
+
+
+def export_csv(days: int, file, now: datetime = None) -> None:
+    """Writes the booked minutes per house, resource and hour of the last days as CSV."""
+    since, until = report_window(days, now)
+    writer = csv.writer(file)
+    writer.writerow(['house', 'resource', 'date', 'weekday', 'hour', 'booked_minutes'])
+    for house_id in HOUSES:
+        for resource_id, hour, minutes in repository.usage_hourly(house_id, since, until):
+            writer.writerow([house_id, resource_id, hour.date().isoformat(), hour.isoweekday(), hour.hour, minutes])
+
+
+def export_csv_bytes(days: int) -> bytes:
+    file = io.StringIO()
+    export_csv(days, file)
+    return file.getvalue().encode('utf-8')
+
+
+if __name__ == '__main__':
+    # python3 analytics.py [days] > usage.csv
+    export_csv(int(sys.argv[1]) if len(sys.argv) > 1 else 365, sys.stdout)
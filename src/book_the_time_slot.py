@@ -1,20 +1,29 @@
 # python-telegram-bot-13.4.1 is used
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, CallbackContext, Filters
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, CallbackContext, Filters, TypeHandler
 from datetime import datetime, timedelta
-# TODO:Should replace sqlite with another DB system - I need to be able to use datetime objects for date and time comparison
-import sqlite3
 import logging
+import signal
+import threading
 import pytz
-import locale
-import requests
-import json
-from concurrent.futures import ThreadPoolExecutor
-from math import floor, ceil
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
-from dateutil.parser import parse as parse_time
+import repository
+from config import (BOT_TOKEN, BOT_RUNTIME, BOT_WORKERS, OUTBOX_WORKERS, BOT_MODE, WEBHOOK_URL, RETENTION_HOUR, ADMIN_IDS,
+                    SUGGESTED_TIMES, TELEGRAM_API_URL)
+from usernames import remember_user
+from schema import DATE_FORMAT, TIME_FORMAT, MAX_BOOKING_SPAN
+from slot_cache import free_slot_cache, BUFFER
+from houses import HOUSES, resolve, label
+from reminders import ReminderEngine
+from waitlist import Waitlist
+from outbox import Outbox
+from webhook import WebhookServer
+from sessions import SessionPersistence
+from pages import page_cache, parse_cursor, ALL, MINE
+from retention import run_retention
+import analytics
+from metrics import timed, Sampled, TimedRequest, start_metrics_server
 
 local_tz = pytz.timezone('Europe/Moscow')
 
@@ -22,63 +31,86 @@ local_tz = pytz.timezone('Europe/Moscow')
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                      level=logging.INFO)
 logger = logging.getLogger(__name__)
-# Create a SQLite database connection
-conn = sqlite3.connect('bookings.db')
+# Create scheduler, it's started in main() so that importing this module doesn't start any threads.
+# Jobs added before that wait in the scheduler and are armed when it starts.
+scheduler = BackgroundScheduler()
 
-# Create a cursor object
-c = conn.cursor()
+# Outgoing messages are queued and sent by worker threads within Telegram's flood limits
+outbox = Outbox()
 
-# Create table
-c.execute('''CREATE TABLE IF NOT EXISTS bookings
-             (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id text, start_booking_date text, end_booking_date text, start_time text, end_time text)''')
+# Sends the start and end reminders, armed by booking events instead of polling the DB
+reminder_engine = ReminderEngine(scheduler)
 
-# Commit the changes to the DB
-conn.commit()
+# Pushes a freed time to the users waiting for it, instead of them checking all bookings again and again
+waitlist = Waitlist(scheduler)
 
-# Create scheduler
-scheduler = BackgroundScheduler()
-scheduler.start()
+# The main menu never changes, it's built once
+START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Забронировать", callback_data='1'),
+     InlineKeyboardButton("Отменить", callback_data='2')],
+    [InlineKeyboardButton("Посмотреть свои стирки", callback_data='3'),
+    InlineKeyboardButton("Просмотреть все стирки", callback_data='4')]
+])
 
+@timed()
 def start(update: Update, context: CallbackContext) -> None:
-    keyboard = [
-        [InlineKeyboardButton("Забронировать", callback_data='1'),
-         InlineKeyboardButton("Отменить", callback_data='2')],
-        [InlineKeyboardButton("Посмотреть свои стирки", callback_data='3'),
-        InlineKeyboardButton("Просмотреть все стирки", callback_data='4')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    # Check if update.message is None
-    if update.message:
-        update.message.reply_text('Пожалуйста, выбери:', reply_markup=reply_markup)
-    else:
-        update.callback_query.message.reply_text('Пожалуйста, выбери:', reply_markup=reply_markup)
+    # Works for both messages and callback queries
+    outbox.send_message(update.effective_chat.id, 'Пожалуйста, выбери:', reply_markup=START_MARKUP)
+
+# Weekday names for generate_dates, by date.weekday(). Spelled out instead of setting the ru_RU
+# locale for %A, which isn't installed everywhere and is process-wide
+WEEKDAYS = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота', 'воскресенье']
 
 # Helper function to generate the next 7 days
 def generate_dates():
-    # Set the locale to Russian
-    try:
-        locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
-    except locale.Error:
-        print("The desired locale is not supported on your system.")
-    
     dates = [datetime.now() + timedelta(days=i) for i in range(7)]
-    return [date.strftime('%d.%m.%Y (%A)') for date in dates]
+    return [f"{date:%d.%m.%Y} ({WEEKDAYS[date.weekday()]})" for date in dates]
 
+@timed()
 def button(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
 
     query.answer()
 
     if query.data == '1':
-        dates = generate_dates()
-        keyboard = [[InlineKeyboardButton(date, callback_data=f'date_{date.split(" ")[0]}')] for date in dates]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(text="Выбери дату:", reply_markup=reply_markup)
+        choose_house(update, context)
+    elif query.data.startswith('house_'):
+        context.user_data['house'] = query.data[6:]
+        choose_resource(update, context)
+    elif query.data.startswith('resource_'):
+        context.user_data['resource'] = query.data[9:]
+        choose_date(update, context)
     elif query.data.startswith('date_'):
         selected_date = query.data[5:]
         context.user_data['selected_date'] = selected_date
         display_not_booked_times(update, context, selected_date)
-        query.edit_message_text(text="Чтобы выйти в главное меню нажми /start\nОтправь мне время, которое хочешь забронировать в формате: '12:30-13:00'")
+        keyboard = [[InlineKeyboardButton(text, callback_data=f'duration_{minutes}') for minutes, text in DURATIONS]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        query.edit_message_text(text="Чтобы выйти в главное меню нажми /start\nОтправь мне время, которое хочешь забронировать в формате: '12:30-13:00'\nИли выбери длительность стирки, и я подберу свободное время:", reply_markup=reply_markup)
+    elif query.data.startswith('duration_'):
+        suggest_times(update, context, int(query.data[9:]), 'any')
+    elif query.data.startswith('part_'):
+        _, minutes, part = query.data.split('_')
+        suggest_times(update, context, int(minutes), part)
+    elif query.data.startswith('slot_'):
+        if query.data.count('_') != 4:
+            # A suggestion from before the buttons held the house and resource, back to the menu
+            start(update, context)
+            return
+        _, house_id, resource_id, start_ts, minutes = query.data.split('_')
+        book_suggested_time(update, context, house_id, resource_id, datetime.strptime(start_ts, '%Y%m%d%H%M'), int(minutes))
+    elif query.data.startswith('wait_'):
+        _, house_id, resource_id, start_ts, minutes = query.data.split('_')
+        join_waitlist(update, context, house_id, resource_id, datetime.strptime(start_ts, '%Y%m%d%H%M'), int(minutes))
+    elif query.data.startswith('waitbook_'):
+        _, house_id, waiter_id = query.data.split('_')
+        book_waited_time(update, context, house_id, int(waiter_id))
+    elif query.data.startswith('page_'):
+        _, kind, direction, *cursor_data = query.data.split('_')
+        show_page(update, context, kind, direction == 'p', cursor_data)
+    elif query.data.startswith('repeat_'):
+        _, house_id, booking_id, weeks = query.data.split('_')
+        repeat_booking(update, context, house_id, int(booking_id), int(weeks))
     elif query.data == '2':
         cancel_time(update, context)
     elif query.data == '3':
@@ -86,81 +118,104 @@ def button(update: Update, context: CallbackContext) -> None:
     elif query.data == '4':
         display_all_bookings(update, context)
 
-def display_not_booked_times(update: Update, context: CallbackContext, selected_date: str) -> None:
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
-
-    # Convert selected_date to datetime object
-    selected_date_dt = datetime.strptime(selected_date, "%d.%m.%Y")
-
-    # Calculate the next date
-    next_date = (selected_date_dt + timedelta(days=1)).strftime("%d.%m.%Y")
-
-    # Query the database for the bookings on the selected date and next date (4 hours into next day)
-    c.execute("""
-        SELECT start_time, end_time, start_booking_date, end_booking_date
-        FROM bookings
-        WHERE
-            (start_booking_date = ? AND strftime('%H:%M', end_time) > '00:00')
-            OR (start_booking_date = ? AND strftime('%H:%M', start_time) < '04:00')
-            OR (end_booking_date = ? AND strftime('%H:%M', end_time) >= '04:00')
-        ORDER BY start_booking_date, start_time
-    """, (selected_date, next_date, selected_date))
-  
-    bookings = c.fetchall()
-
-    conn.close()
-
-    # List to keep track of free time slots
-    free_time_slots = []
-
-    # Start of the day
-    current_time = datetime.strptime(selected_date + " 00:00", "%d.%m.%Y %H:%M")
-
-    # Loop through the booked time slots
-    for booking in bookings:
-        start_time, end_time, start_booking_date, end_booking_date = booking
-        start_time_dt = datetime.strptime(f"{start_booking_date} {start_time}", "%d.%m.%Y %H:%M") - timedelta(minutes=30)
-        end_time_dt = datetime.strptime(f"{end_booking_date} {end_time}", "%d.%m.%Y %H:%M") + timedelta(minutes=30)
-
-        # Check if there is a free slot before this booking
-        if (start_time_dt - current_time).total_seconds() > 0:
-            free_time_slots.append((current_time.strftime("%d.%m.%Y %H:%M"), (start_time_dt - timedelta(minutes=1)).strftime("%d.%m.%Y %H:%M")))
-
-        # Update the current_time to the end of this booking
-        current_time = end_time_dt + timedelta(minutes=1)  # 1-minute cooldown period
-
-    # Check for free time slot between the last booking and 04:00 of the next day
-    end_of_extended_day = datetime.strptime(next_date + " 04:00", "%d.%m.%Y %H:%M")
-    if (end_of_extended_day - current_time).total_seconds() > 0:
-        free_time_slots.append((current_time.strftime("%d.%m.%Y %H:%M"), end_of_extended_day.strftime("%d.%m.%Y %H:%M")))
-
-    # Construct and send the message
-    if free_time_slots:
-        message_text = "Свободное время в выбранный день + 4 часа после:\n"
-        for start, end in free_time_slots:
-            start_date, start_time = start.split(" ")
-            end_date, end_time = end.split(" ")
-
-            # Rounding start_time for display
-            start_time_hour, start_time_minute = map(int, start_time.split(":"))
-            start_time_minute = floor(start_time_minute / 5) * 5
-            start_time = f"{start_time_hour:02d}:{start_time_minute:02d}"
-
-            # Rounding end_time for display
-            end_time_hour, end_time_minute = map(int, end_time.split(":"))
-            end_time_minute = ceil(end_time_minute / 5) * 5
-            if end_time_minute == 60:
-                end_time_hour += 1
-                end_time_minute = 0
-            end_time = f"{end_time_hour:02d}:{end_time_minute:02d}"
+# The house and resource steps are skipped when there is only one to choose from
+def choose_house(update: Update, context: CallbackContext) -> None:
+    if len(HOUSES) == 1:
+        context.user_data['house'] = next(iter(HOUSES))
+        choose_resource(update, context)
+        return
+    keyboard = [[InlineKeyboardButton(house.name, callback_data=f'house_{house.id}')] for house in HOUSES.values()]
+    update.callback_query.edit_message_text(text="Выбери дом:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+def choose_resource(update: Update, context: CallbackContext) -> None:
+    house, _ = resolve(context.user_data.get('house'), None)
+    if len(house.resources) == 1:
+        context.user_data['resource'] = house.resources[0].id
+        choose_date(update, context)
+        return
+    keyboard = [[InlineKeyboardButton(resource.name, callback_data=f'resource_{resource.id}')] for resource in house.resources]
+    update.callback_query.edit_message_text(text="Выбери машину:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+def choose_date(update: Update, context: CallbackContext) -> None:
+    dates = generate_dates()
+    keyboard = [[InlineKeyboardButton(date, callback_data=f'date_{date.split(" ")[0]}')] for date in dates]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    update.callback_query.edit_message_text(text="Выбери дату:", reply_markup=reply_markup)
 
-            message_text += f"{start_date} - {end_date}        {start_time} - {end_time}\n"
+@timed()
+def display_not_booked_times(update: Update, context: CallbackContext, selected_date: str) -> None:
+    # Free slots of the selected resource on the selected day plus 4 hours into the next one,
+    # served from memory once the day is cached
+    house, resource = resolve(context.user_data.get('house'), context.user_data.get('resource'))
+    message_text = free_slot_cache.message(house.id, resource.id, datetime.strptime(selected_date, DATE_FORMAT).date())
+    outbox.send_message(update.effective_chat.id, message_text)
+
+# Durations offered for the suggestions, within the 30 minutes to 3 hours that need no confirmation
+DURATIONS = [(30, "30 мин"), (60, "1 ч"), (90, "1,5 ч"), (120, "2 ч"), (180, "3 ч")]
+DURATION_MINUTES = {minutes for minutes, _ in DURATIONS}
+
+# Parts of the day to look for free time in, in hours from the start of the selected day
+DAY_PARTS = {
+    'any': ("Любое", 0, 28),
+    'morning': ("Утро", 6, 12),
+    'day': ("День", 12, 18),
+    'evening': ("Вечер", 18, 24),
+    'night': ("Ночь", 24, 28),
+}
+
+@timed()
+def suggest_times(update: Update, context: CallbackContext, minutes: int, part: str) -> None:
+    # Callback data comes from the client, only the offered durations are accepted
+    if minutes not in DURATION_MINUTES:
+        return
+    if 'selected_date' not in context.user_data:
+        outbox.send_message(update.effective_chat.id, "Сперва выбери дату стирки")
+        start(update, context)
+        return
+
+    house, resource = resolve(context.user_data.get('house'), context.user_data.get('resource'))
+    booking_day = datetime.strptime(context.user_data['selected_date'], DATE_FORMAT)
+    _, first_hour, last_hour = DAY_PARTS.get(part, DAY_PARTS['any'])
+    now = datetime.now(local_tz).replace(tzinfo=None)
+
+    # Only start times that keep the 30-minute buffer to every booking and aren't in the past
+    start_times = free_slot_cache.suggest_start_times(
+        house.id, resource.id, booking_day.date(), timedelta(minutes=minutes),
+        booking_day + timedelta(hours=first_hour), booking_day + timedelta(hours=last_hour), now, SUGGESTED_TIMES)
+
+    keyboard = []
+    for start_datetime in start_times:
+        end_datetime = start_datetime + timedelta(minutes=minutes)
+        text = f"{start_datetime:%H:%M} - {end_datetime:%H:%M}"
+        if start_datetime.date() != booking_day.date():
+            text += f" ({start_datetime:%d.%m})"
+        keyboard.append([InlineKeyboardButton(text, callback_data=f'slot_{house.id}_{resource.id}_{start_datetime:%Y%m%d%H%M}_{minutes}')])
+    keyboard.append([InlineKeyboardButton(name, callback_data=f'part_{minutes}_{key}')
+                     for key, (name, _, _) in DAY_PARTS.items() if key != part])
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        context.bot.send_message(chat_id=update.effective_chat.id, text=message_text)
+    if start_times:
+        text = "Чтобы выйти в главное меню нажми /start\nВыбери время стирки:"
     else:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="В этот день все занято, выбери другой день для стирки")
+        text = "Чтобы выйти в главное меню нажми /start\nВ это время все занято, выбери другое время дня или другой день"
+    update.callback_query.edit_message_text(text=text, reply_markup=reply_markup)
+
+def book_suggested_time(update: Update, context: CallbackContext, house_id: str, resource_id: str,
+                        start_datetime: datetime, minutes: int) -> None:
+    # The button holds the house and resource it was suggested for, the user may have picked others since
+    house = HOUSES.get(house_id)
+    if house is None or resource_id not in {resource.id for resource in house.resources} or minutes not in DURATION_MINUTES:
+        return
+    # The buttons may be old, the time has to be checked again
+    if start_datetime < datetime.now(local_tz).replace(tzinfo=None):
+        outbox.send_message(update.effective_chat.id, "Время бронирования уже прошло. Выбери время в будущем.")
+        start(update, context)
+        return
+    context.user_data['house'] = house_id
+    context.user_data['resource'] = resource_id
+    book_slot(update, context, start_datetime, start_datetime + timedelta(minutes=minutes))
 
+@timed()
 def book_time(update: Update, context: CallbackContext) -> None:
     if update.message is not None:
         message_text = update.message.text if update.message else update.callback_query.message.text
@@ -178,14 +233,13 @@ def book_time(update: Update, context: CallbackContext) -> None:
                 combined_start_datetime_naive = datetime.strptime(f"{booking_date} {start_time}", "%d.%m.%Y %H:%M")
                 
                 # Convert combined_start_datetime to timezone aware
-                moscow_tz = pytz.timezone('Europe/Moscow')
-                combined_start_datetime = moscow_tz.localize(combined_start_datetime_naive)
+                combined_start_datetime = local_tz.localize(combined_start_datetime_naive)
                 
                 # Get current datetime with timezone
-                current_datetime = datetime.now(moscow_tz)
+                current_datetime = datetime.now(local_tz)
                 
                 if combined_start_datetime < current_datetime:
-                    update.message.reply_text("Время бронирования уже прошло. Выбери время в будущем.")
+                    outbox.send_message(update.effective_chat.id, "Время бронирования уже прошло. Выбери время в будущем.")
                     start(update, context)
                     return
 
@@ -196,7 +250,7 @@ def book_time(update: Update, context: CallbackContext) -> None:
                         [InlineKeyboardButton("Нет", callback_data='confirm_no')]
                     ]
                     reply_markup = InlineKeyboardMarkup(keyboard)
-                    update.message.reply_text("Время начала стирки позднее, чем время окончания.\nТы хочешь забронировать с текущего дня по следующий?", reply_markup=reply_markup)
+                    outbox.send_message(update.effective_chat.id, "Время начала стирки позднее, чем время окончания.\nТы хочешь забронировать с текущего дня по следующий?", reply_markup=reply_markup)
                     context.user_data['start_time'] = start_time
                     context.user_data['end_time'] = end_time
                     return
@@ -211,7 +265,7 @@ def book_time(update: Update, context: CallbackContext) -> None:
                         [InlineKeyboardButton("Нет", callback_data='confirm_no')]
                     ]
                     reply_markup = InlineKeyboardMarkup(keyboard)
-                    update.message.reply_text("Длительность стирки меньше получаса или дольше 3 часов.\nТы хочешь забронировать это время?", reply_markup=reply_markup)
+                    outbox.send_message(update.effective_chat.id, "Длительность стирки меньше получаса или дольше 3 часов.\nТы хочешь забронировать это время?", reply_markup=reply_markup)
                     context.user_data['start_time'] = start_time
                     context.user_data['end_time'] = end_time
                     return
@@ -219,12 +273,13 @@ def book_time(update: Update, context: CallbackContext) -> None:
                 process_booking(update, context, start_time, end_time)
 
             except ValueError:
-                update.message.reply_text("Пожалуйста, введи время в верном формате '12:30-13:00'")
+                outbox.send_message(update.effective_chat.id, "Пожалуйста, введи время в верном формате '12:30-13:00'")
 
         else:
-            update.message.reply_text("Сперва выбери дату стирки")
+            outbox.send_message(update.effective_chat.id, "Сперва выбери дату стирки")
             start(update, context)
 
+@timed()
 def confirm_booking(update: Update, context: CallbackContext) -> None:
     if update.callback_query.data == 'confirm_yes':
         start_time = context.user_data['start_time']
@@ -238,106 +293,158 @@ def confirm_booking(update: Update, context: CallbackContext) -> None:
     elif update.callback_query.data == 'confirm_no':
         start(update, context)  # Restart dialog
 
+@timed()
 def process_booking(update: Update, context: CallbackContext, start_time: str, end_time: str) -> None:
-    booking_start_date = context.user_data['selected_date']
-    booking_end_date = booking_start_date
-    user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
+    # Convert the times to datetime objects on the booking date
+    booking_day = datetime.strptime(context.user_data['selected_date'], DATE_FORMAT)
+    start_datetime = datetime.combine(booking_day, datetime.strptime(start_time, "%H:%M").time())
+    end_datetime = datetime.combine(booking_day, datetime.strptime(end_time, "%H:%M").time())
 
-    # To handle callback_query as well as message
-    reply_func = update.message.reply_text if update.message else update.callback_query.message.reply_text
+    # If start_time is later than or equal to end_time, the booking spans across two days
+    if start_datetime >= end_datetime:
+        end_datetime += timedelta(days=1)
 
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
+    book_slot(update, context, start_datetime, end_datetime)
 
-    # Convert the times to datetime objects
-    start_time_datetime = parse_time(start_time)
-    end_time_datetime = parse_time(end_time)
+# How many weeks in a row a booking can be repeated, the first week included
+REPEAT_WEEKS = [(4, "4 недели"), (8, "8 недель"), (12, "12 недель")]
 
-    try:
-        # Subtract 30 minutes from the start time and add 30 minutes to the end time for buffer
-        start_time_30_min_prior = (start_time_datetime - timedelta(minutes=30)).strftime('%H:%M')
-        end_time_30_min_after = (end_time_datetime + timedelta(minutes=30)).strftime('%H:%M')
-
-        # Check if the time slot is available
-        c.execute("SELECT * FROM bookings WHERE start_booking_date = ? AND (start_time < ? AND end_time > ?)",
-                    (booking_start_date, end_time_30_min_after, start_time_30_min_prior))
-        if c.fetchone() is None:
-            # If start_time is later than or equal to end_time, the booking spans across two days
-            if start_time >= end_time:
-                booking_end_date = (datetime.strptime(booking_start_date, "%d.%m.%Y") + timedelta(days=1)).strftime('%d.%m.%Y')
-
-            c.execute("INSERT INTO bookings VALUES (NULL, ?, ?, ?, ?, ?)",
-                      (user_id, booking_start_date, booking_end_date, start_time, end_time))
-            conn.commit()
-
-            reply_func(f"Успешно забронировал стирку с {booking_start_date} {start_time} до {booking_end_date} {end_time}")
-        else:
-            reply_func("Время за 30 минут до начала или 30 минут после уже занято. Выбери другое время")
+@timed()
+def book_slot(update: Update, context: CallbackContext, start_datetime: datetime, end_datetime: datetime) -> None:
+    house, resource = resolve(context.user_data.get('house'), context.user_data.get('resource'))
+    user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
 
-    finally:
-        conn.close()
+    booking_start_date = start_datetime.strftime(DATE_FORMAT)
+    booking_end_date = end_datetime.strftime(DATE_FORMAT)
+    start_time = start_datetime.strftime(TIME_FORMAT)
+    end_time = end_datetime.strftime(TIME_FORMAT)
 
-    start(update, context)
-  
-def view_bookings(update: Update, context: CallbackContext) -> None:
-    user_id = update.callback_query.from_user.id
+    # Check the 30-minute buffer (including bookings that cross midnight) and book in one transaction
+    booking_id = repository.book(house.id, resource.id, user_id, start_datetime, end_datetime, BUFFER)
+    if booking_id is not None:
+        free_slot_cache.add_booking(house.id, resource.id, start_datetime, end_datetime)
+        reminder_engine.booking_created(house.id, booking_id, user_id, start_datetime, end_datetime)
+        page_cache.invalidate(user_id)
 
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
+        keyboard = [[InlineKeyboardButton(text, callback_data=f'repeat_{house.id}_{booking_id}_{weeks}') for weeks, text in REPEAT_WEEKS]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        outbox.send_message(update.effective_chat.id, f"Успешно забронировал стирку с {booking_start_date} {start_time} до {booking_end_date} {end_time}{label(house.id, resource.id)}\nПовторять ее каждую неделю?", reply_markup=reply_markup)
+    else:
+        minutes = int((end_datetime - start_datetime).total_seconds() // 60)
+        keyboard = [[InlineKeyboardButton("🔔 Сообщить, когда освободится", callback_data=f'wait_{house.id}_{resource.id}_{start_datetime:%Y%m%d%H%M}_{minutes}')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        outbox.send_message(update.effective_chat.id, "Время за 30 минут до начала или 30 минут после уже занято. Выбери другое время", reply_markup=reply_markup)
 
-    # Get the current date and time
-    current_date = datetime.now().strftime('%d.%m.%Y')
-    current_time = datetime.now().strftime('%H:%M')
+    start(update, context)
 
-    # Retrieving the user's bookings
-    c.execute("""
-        SELECT * FROM bookings
-        WHERE user_id = ? AND ((start_booking_date > ?) OR (start_booking_date = ? AND end_time > ?))
-        ORDER BY start_booking_date, start_time
-    """, (user_id, current_date, current_date, current_time))
+@timed()
+def join_waitlist(update: Update, context: CallbackContext, house_id: str, resource_id: str, start_datetime: datetime, minutes: int) -> None:
+    query = update.callback_query
+    house = HOUSES.get(house_id)
+    if house is None or resource_id not in {resource.id for resource in house.resources}:
+        return
+    # Typed times can last any number of minutes, but never longer than a booking may
+    if not 0 < minutes <= MAX_BOOKING_SPAN.total_seconds() // 60:
+        return
+    end_datetime = start_datetime + timedelta(minutes=minutes)
+    if start_datetime < datetime.now(local_tz).replace(tzinfo=None):
+        query.edit_message_text("Время бронирования уже прошло. Выбери время в будущем.")
+        return
+
+    if waitlist.subscribe(house_id, resource_id, query.from_user.id, start_datetime, end_datetime):
+        query.edit_message_text(f"Сообщу, как только время с {start_datetime:%d.%m.%Y %H:%M} до {end_datetime:%d.%m.%Y %H:%M}{label(house_id, resource_id)} освободится")
+    else:
+        query.edit_message_text("Ты уже ждешь это время")
 
-    bookings = c.fetchall()
+@timed()
+def book_waited_time(update: Update, context: CallbackContext, house_id: str, waiter_id: int) -> None:
+    query = update.callback_query
+    offer = waitlist.claim(house_id, waiter_id, query.from_user.id) if house_id in HOUSES else None
+    if offer is None:
+        query.edit_message_text("Это предложение уже не действует")
+        return
+
+    resource_id, start_datetime, end_datetime = offer
+    query.edit_message_text(query.message.text)
+    if start_datetime < datetime.now(local_tz).replace(tzinfo=None):
+        waitlist.done(house_id, waiter_id)
+        outbox.send_message(update.effective_chat.id, "Время бронирования уже прошло. Выбери время в будущем.")
+        start(update, context)
+        return
+    context.user_data['house'] = house_id
+    context.user_data['resource'] = resource_id
+    book_slot(update, context, start_datetime, end_datetime)
+    waitlist.done(house_id, waiter_id)
+  
+@timed()
+def repeat_booking(update: Update, context: CallbackContext, house_id: str, booking_id: int, weeks: int) -> None:
+    query = update.callback_query
+    if house_id not in HOUSES or weeks not in dict(REPEAT_WEEKS):
+        return
+
+    # The occurrences are checked and booked all at once, the taken weeks are skipped
+    result = repository.repeat_booking(house_id, booking_id, query.from_user.id, weeks, timedelta(weeks=1),
+                                       BUFFER, datetime.now())
+    if result is None:
+        query.edit_message_text("Эта стирка уже отменена или уже повторяется")
+        return
+
+    rule_id, created, taken = result
+    page_cache.invalidate(query.from_user.id)
+    for id, resource_id, start_datetime, end_datetime in created:
+        free_slot_cache.add_booking(house_id, resource_id, start_datetime, end_datetime)
+        reminder_engine.booking_created(house_id, id, query.from_user.id, start_datetime, end_datetime)
+
+    message_text = query.message.text.split('\n')[0] + '\n'
+    if created:
+        message_text += f"Повторяется каждую неделю до {created[-1][2]:%d.%m.%Y}, забронировано еще {len(created)}"
+    if taken:
+        message_text += "\nЭто время уже занято: " + ', '.join(f"{start:%d.%m}" for start in taken)
+    query.edit_message_text(message_text)
+
+@timed()
+def view_bookings(update: Update, context: CallbackContext) -> None:
+    user_id = update.callback_query.from_user.id
 
-    conn.close()
+    # The first page of the user's upcoming bookings, the buttons under it turn the pages
+    message_text, reply_markup = page_cache.page(MINE, user_id)
 
-    if bookings:
-        message_text = "Твои стирки:\n"
-        for booking in bookings:
-            id, _, start_booking_date, end_booking_date, start_time, end_time = booking
-            message_text += f"С {start_booking_date} {start_time} до {end_booking_date} {end_time}\n"
-        update.callback_query.edit_message_text(message_text)
+    if message_text:
+        update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
     else:
         update.callback_query.edit_message_text("У тебя нет предстоящих стирок")
     start(update, context)
 
+@timed()
+def show_page(update: Update, context: CallbackContext, kind: str, backwards: bool, cursor_data) -> None:
+    try:
+        cursor = parse_cursor(*cursor_data)
+    except ValueError:
+        # A button from before the houses changed, start from the first page
+        cursor = None
+    message_text, reply_markup = page_cache.page(kind, update.callback_query.from_user.id, cursor, backwards)
+    update.callback_query.edit_message_text(message_text or "Здесь больше нет стирок", reply_markup=reply_markup)
+
 
+@timed()
 def cancel_time(update: Update, context: CallbackContext) -> None:
     user_id = update.callback_query.from_user.id
 
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
-
-    now = datetime.now()
-
-    # Convert the datetime to the format used in the database
-    current_datetime = now.strftime('%d.%m.%Y %H:%M')
-
     # Retrieve the user's bookings that are later than the current time
-    c.execute("""
-        SELECT * FROM bookings
-        WHERE user_id = ? AND start_booking_date || ' ' || end_time > ?
-        ORDER BY start_booking_date, start_time
-    """, (user_id, current_datetime))
-
-    bookings = c.fetchall()
-
-    conn.close()
+    bookings = repository.user_upcoming_bookings(user_id, datetime.now())
 
     if bookings:
         keyboard = []
+        rules = {}
         for booking in bookings:
-            id, _, start_booking_date, end_booking_date, start_time, end_time = booking
-            keyboard.append([InlineKeyboardButton(f"С {start_booking_date} {start_time} до {end_booking_date} {end_time}", callback_data=f'cancel_{id}_{start_booking_date}_{end_booking_date}_{start_time}_{end_time}')])
+            house_id, id, resource_id, start_booking_date, end_booking_date, start_time, end_time, rule_id = booking
+            # The dates are looked up again on cancel, callback data is limited to 64 bytes
+            keyboard.append([InlineKeyboardButton(f"С {start_booking_date} {start_time} до {end_booking_date} {end_time}{label(house_id, resource_id)}", callback_data=f'cancel_{house_id}_{id}')])
+            if rule_id is not None:
+                rules.setdefault((house_id, rule_id), f"{start_booking_date} {start_time}{label(house_id, resource_id)}")
+        # One more button per weekly booking, for all of its upcoming weeks
+        for (house_id, rule_id), text in rules.items():
+            keyboard.append([InlineKeyboardButton(f"🔁 Все повторы с {text}", callback_data=f'cancelrule_{house_id}_{rule_id}')])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         update.callback_query.edit_message_text('Чтобы выйти в главное меню нажми /start\nВыбери время, которое хочешь отменить:', reply_markup=reply_markup)
@@ -345,79 +452,149 @@ def cancel_time(update: Update, context: CallbackContext) -> None:
         update.callback_query.edit_message_text("Чтобы выйти в главное меню нажми /start\nУ тебя нет забронированных стирок")
 
 
+@timed()
 def delete_booking(update: Update, context: CallbackContext) -> None:
     if update.callback_query.data.startswith('cancel_'):
-        user_id = update.callback_query.from_user.id
-        _, id, start_booking_date, end_booking_date, start_time, end_time = update.callback_query.data.split('_')
-
-        conn = sqlite3.connect('bookings.db')
-        c = conn.cursor()
-
-        # Delete the booking
-        c.execute("DELETE FROM bookings WHERE id = ?", (id,))
-
-        conn.commit()
-
-        conn.close()
+        parts = update.callback_query.data.split('_')
+        if len(parts) == 3:
+            _, house_id, id = parts
+        else:
+            # Buttons sent before there were houses: cancel_<id>_<dates and times>
+            house_id, id = next(iter(HOUSES)), parts[1]
 
-        update.callback_query.edit_message_text(f"Стирка с {start_booking_date} {end_booking_date} до {start_time} {end_time} была отменена")
+        # Delete the booking and free its slot in the cached days, only the user's own bookings can be cancelled
+        user_id = update.callback_query.from_user.id
+        booking = repository.delete_booking(house_id, id, user_id) if house_id in HOUSES else None
+        if booking is not None:
+            resource_id, start_datetime, end_datetime = booking
+            free_slot_cache.remove_booking(house_id, resource_id, start_datetime, end_datetime)
+            reminder_engine.booking_cancelled(house_id, int(id))
+            page_cache.invalidate(user_id)
+            waitlist.slot_freed(house_id, resource_id, start_datetime, end_datetime)
+            update.callback_query.edit_message_text(f"Стирка с {start_datetime:%d.%m.%Y %H:%M} до {end_datetime:%d.%m.%Y %H:%M}{label(house_id, resource_id)} была отменена")
+        else:
+            update.callback_query.edit_message_text("Эта стирка уже была отменена")
         start(update, context)
 
-def send_reminder(user_id: int, start_booking_date: str, end_booking_date: str, start_time: str, end_time: str) -> None:
-    context.bot.send_message(chat_id=user_id, text=f"Ранее ты забронировал стирку с {start_booking_date} {end_booking_date} до {start_time} {end_time}. Это твое 15-минутное напоминание.")
-
-def get_username(user_id):
-    response = requests.get(f"https://api.telegram.org/bot6068997270:AAF5kfctIwGasJTLM0c-0RFDNmUSABaZktQ/getChat?chat_id={user_id}")
-    data = json.loads(response.text)
-    return data["result"]["username"]
+@timed()
+def delete_rule(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    _, house_id, rule_id = query.data.split('_')
 
-def get_usernames(user_ids):
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        return list(executor.map(get_username, user_ids))
+    deleted = repository.delete_rule(house_id, int(rule_id), query.from_user.id, datetime.now()) if house_id in HOUSES else None
+    if deleted is None:
+        query.edit_message_text("Эти стирки уже были отменены")
+    else:
+        page_cache.invalidate(query.from_user.id)
+        for id, resource_id, start_datetime, end_datetime in deleted:
+            free_slot_cache.remove_booking(house_id, resource_id, start_datetime, end_datetime)
+            reminder_engine.booking_cancelled(house_id, id)
+            waitlist.slot_freed(house_id, resource_id, start_datetime, end_datetime)
+        query.edit_message_text(f"Отменено стирок: {len(deleted)}, больше они не повторяются")
+    start(update, context)
 
+@timed()
 def display_all_bookings(update: Update, context: CallbackContext) -> None:
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
-
-    c.execute("""
-        SELECT * 
-        FROM bookings 
-        WHERE DATE(SUBSTR(start_booking_date, 7, 4) || '-' || SUBSTR(start_booking_date, 4, 2) || '-' || SUBSTR(start_booking_date, 1, 2)) >= DATE('now', '-3 day') 
-        ORDER BY DATE(SUBSTR(start_booking_date, 7, 4) || '-' || SUBSTR(start_booking_date, 4, 2) || '-' || SUBSTR(start_booking_date, 1, 2)), start_time
-    """)
-
-    all_bookings = c.fetchall()
-
-    usernames = get_usernames([booking[1] for booking in all_bookings])
-
-    formatted_bookings = []
-    for booking, username in zip(all_bookings, usernames):
-        user_id, start_date, end_date, start_time, end_time = booking[1:]
-        formatted_booking = f"@{username} - с {start_date} {start_time} до {end_date} {end_time}"
-        formatted_bookings.append(formatted_booking)
-    
-    c.close()
-    conn.close()
-
-    if formatted_bookings:
-        update.callback_query.message.reply_text('\n'.join(formatted_bookings))
+    # One page of the bookings since three days ago, the usernames are only looked up for its rows
+    message_text, reply_markup = page_cache.page(ALL, None)
+
+    if message_text:
+        outbox.send_message(update.effective_chat.id, message_text, reply_markup=reply_markup)
     else:
-        update.callback_query.message.reply_text('No bookings in the last 3 days.')
+        outbox.send_message(update.effective_chat.id, 'No bookings in the last 3 days.')
+
+# Admin commands, /stats [days] shows the occupancy report of every house, /export [days] sends it as CSV
+def report_days(context: CallbackContext) -> int:
+    return int(context.args[0]) if context.args and context.args[0].isdigit() else 30
+
+@timed()
+def stats(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    days = report_days(context)
+    for house_id in HOUSES:
+        outbox.send_message(update.effective_chat.id, analytics.render_report(house_id, analytics.report(house_id, days)), parse_mode='HTML')
+
+@timed()
+def export(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    days = report_days(context)
+    context.bot.send_document(update.effective_chat.id, analytics.export_csv_bytes(days), filename=f'usage_{days}d.csv')
+
+def register_handlers(dispatcher, run_async: bool = BOT_RUNTIME == 'async') -> None:
+    # Load the conversation state another process or a previous run left, before any handler reads it
+    if isinstance(dispatcher.persistence, SessionPersistence):
+        dispatcher.add_handler(TypeHandler(Update, dispatcher.persistence.refresh), group=-2)
+    # Keep the cached usernames fresh from every update the users send
+    dispatcher.add_handler(TypeHandler(Update, remember_user, run_async=run_async), group=-1)
+    dispatcher.add_handler(CommandHandler("start", start, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("stats", stats, run_async=run_async))
+    dispatcher.add_handler(CommandHandler("export", export, run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(button, pattern='^(?!cancel_|cancelrule_|confirm_)', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(delete_booking, pattern='^cancel_', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(delete_rule, pattern='^cancelrule_', run_async=run_async))
+    dispatcher.add_handler(CallbackQueryHandler(confirm_booking, pattern='^confirm_', run_async=run_async))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, book_time, run_async=run_async))
 
 def main() -> None:
-    updater = Updater('6068997270:AAF5kfctIwGasJTLM0c-0RFDNmUSABaZktQ', use_context=True)
+    if not BOT_TOKEN:
+        raise SystemExit("BOT_TOKEN is not set, export the token you've received from the BotFather")
 
-    dispatcher = updater.dispatcher
+    # Half-finished bookings survive restarts and are shared with the other bot processes
+    persistence = SessionPersistence()
 
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CallbackQueryHandler(button, pattern='^(?!cancel_|confirm_)'))
-    dispatcher.add_handler(CallbackQueryHandler(delete_booking, pattern='^cancel_'))
-    dispatcher.add_handler(CallbackQueryHandler(confirm_booking, pattern='^confirm_'))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, book_time))
+    # The handler workers and the outbox workers all share the bot's HTTP connection pool,
+    # every Bot API call is timed for the metrics
+    bot = Bot(BOT_TOKEN, base_url=f'{TELEGRAM_API_URL}/bot', request=TimedRequest(con_pool_size=BOT_WORKERS + OUTBOX_WORKERS + 4))
+    updater = Updater(bot=bot, use_context=True, workers=BOT_WORKERS, persistence=persistence)
 
-    updater.start_polling()
+    dispatcher = updater.dispatcher
 
-    updater.idle()
+    outbox.start(updater.bot)
+    reminder_engine.start(outbox)
+    waitlist.start(outbox)
+    scheduler.start()
+
+    # Archives old bookings in small batches beside the handlers, at night when nobody is booking
+    scheduler.add_job(run_retention, 'cron', hour=RETENTION_HOUR, id='retention', replace_existing=True,
+                      misfire_grace_time=3600, coalesce=True)
+
+    register_handlers(dispatcher)
+
+    Sampled('booking_bot_scheduler_jobs', 'Jobs waiting in the scheduler.', 'gauge', lambda: len(scheduler.get_jobs()))
+    Sampled('booking_bot_reminders_pending', 'Reminders waiting for their time.', 'gauge', reminder_engine.pending)
+    Sampled('booking_bot_outbox_queued', 'Messages waiting in the outbox.', 'gauge', outbox.queue_size)
+    Sampled('booking_bot_outbox_events_total', 'Outbox events since the start.', 'counter',
+            lambda: {event: value for event, value in outbox.metrics().items() if event != 'queued'}, label='event')
+    Sampled('booking_bot_update_queue', 'Updates waiting for the dispatcher.', 'gauge', dispatcher.update_queue.qsize)
+    start_metrics_server()
+
+    # Block until Ctrl+C or SIGTERM. The handlers are set before any update is taken, so a supervisor
+    # that stops the bot right after starting it still gets a clean stop instead of killing it
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    if BOT_MODE == 'webhook':
+        webhook = WebhookServer(dispatcher)
+        Sampled('booking_bot_webhook_queue', 'Updates waiting for the webhook workers.', 'gauge', webhook.updates.qsize)
+        Sampled('booking_bot_webhook_events_total', 'Webhook requests since the start.', 'counter',
+                lambda: dict(webhook.metrics), label='event')
+        webhook.start()
+        webhook.set_webhook(WEBHOOK_URL)
+        stop.wait()
+        webhook.stop()
+    else:
+        updater.start_polling()
+        stop.wait()
+        updater.stop()
+    # Let the reminders that are due finish, send what is still queued, including reminders already
+    # marked as sent, then save what the handlers finished before exiting
+    scheduler.shutdown()
+    outbox.stop()
+    dispatcher.update_persistence()
+    persistence.flush()
 
 if __name__ == '__main__':
     main()
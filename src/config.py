@@ -0,0 +1,104 @@
+import os
+
+# Settings shared by the bot and the background services.
+# Every value can be overridden with an environment variable of the same name.
+
+DB_PATH = os.environ.get('DB_PATH', 'bookings.db')
+
+# Number of SQLite connections kept open per process
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+
+# How long a statement waits for another writer before failing with 'database is locked', in seconds
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '10'))
+
+# Number of days whose free slots are kept in memory, counted per resource, and for at most how
+# many seconds. Bookings made by other bot processes show up once a day's entry is that old
+FREE_SLOT_CACHE_DAYS = int(os.environ.get('FREE_SLOT_CACHE_DAYS', '64'))
+FREE_SLOT_CACHE_SECONDS = float(os.environ.get('FREE_SLOT_CACHE_SECONDS', '60'))
+
+# The token you've received from the BotFather, the bot processes refuse to start without it
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
+
+# Base URL of the Bot API, can point to a local stub server
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Timeout of the getChat lookups, in seconds
+TELEGRAM_API_TIMEOUT = float(os.environ.get('TELEGRAM_API_TIMEOUT', '5'))
+
+# How long a cached username is considered fresh, in hours
+USERNAME_TTL_HOURS = float(os.environ.get('USERNAME_TTL_HOURS', '168'))
+
+# Reminders that were due while the bot was down are still sent if they are at most this late, in minutes
+REMINDER_CATCH_UP_MINUTES = int(os.environ.get('REMINDER_CATCH_UP_MINUTES', '30'))
+
+# How often the standalone reminder service reloads the pending reminders, in minutes
+REMINDER_SYNC_MINUTES = int(os.environ.get('REMINDER_SYNC_MINUTES', '5'))
+
+# Outgoing messages: worker threads, and the sending rates in messages per second,
+# kept below the Bot API flood limits of 30 per second overall and about 1 per second per chat
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', '25'))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+
+# 'threaded' handles the updates one after another on the dispatcher thread,
+# 'async' hands every update to a pool of BOT_WORKERS threads so slow handlers don't hold up the others
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threaded')
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '16'))
+
+# 'polling' long-polls getUpdates, 'webhook' receives the updates on an embedded HTTP server
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+
+# Public HTTPS URL Telegram posts the updates to (usually a reverse proxy in front of WEBHOOK_PORT)
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+# Sent back by Telegram in the X-Telegram-Bot-Api-Secret-Token header, updates without it are rejected
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+# Threads that pass the queued updates to the handlers, and how many updates may wait for them
+# before new ones are refused with 503 and retried by Telegram later
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# Bookings that started more than RETENTION_DAYS ago are moved to the compressed archive,
+# houses.json can set "retention_days" per house. The retention job runs inside the bot
+# every day at RETENTION_HOUR, in batches of RETENTION_BATCH_SIZE rows with a pause of
+# RETENTION_PAUSE_SECONDS in between, then returns up to RETENTION_VACUUM_PAGES free pages to the disk
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '7'))
+RETENTION_HOUR = int(os.environ.get('RETENTION_HOUR', '4'))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+RETENTION_PAUSE_SECONDS = float(os.environ.get('RETENTION_PAUSE_SECONDS', '0.05'))
+RETENTION_VACUUM_PAGES = int(os.environ.get('RETENTION_VACUUM_PAGES', '2000'))
+
+# JSON file that describes the houses and their resources (washing machines, dryers),
+# without it there is a single house with one washing machine stored in DB_PATH
+HOUSES_FILE = os.environ.get('HOUSES_FILE', 'houses.json')
+
+# Conversation state (the date and times picked halfway through a booking) is kept in the
+# database so restarts and other bot processes can continue it. Changes are written in batches
+# every SESSION_FLUSH_SECONDS, sessions untouched for SESSION_TTL_HOURS are dropped, and at most
+# SESSION_CACHE_SIZE sessions are kept in memory
+SESSION_FLUSH_SECONDS = float(os.environ.get('SESSION_FLUSH_SECONDS', '0.5'))
+SESSION_TTL_HOURS = float(os.environ.get('SESSION_TTL_HOURS', '24'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+
+# Telegram user ids allowed to use the admin commands (/stats, /export), separated by commas
+ADMIN_IDS = {int(user_id) for user_id in os.environ.get('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# How many free start times are offered as buttons once the user picked a duration
+SUGGESTED_TIMES = int(os.environ.get('SUGGESTED_TIMES', '6'))
+
+# Local HTTP endpoint with the Prometheus metrics (/metrics) and the sampling profiler (/profile), 0 turns it off.
+# Give the standalone reminder service a different port than the bot if both run on one host.
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9108'))
+
+# When a cancelled booking frees the time a user waits for, it is held for them this many minutes
+# before the next user on the waitlist is offered it
+WAITLIST_HOLD_MINUTES = float(os.environ.get('WAITLIST_HOLD_MINUTES', '5'))
+
+# Booking lists are shown PAGE_SIZE bookings at a time, rendered pages are cached for at most PAGE_CACHE_SECONDS
+# (changes made by this process clear them at once, the limit covers the other bot processes)
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '20'))
+PAGE_CACHE_SECONDS = float(os.environ.get('PAGE_CACHE_SECONDS', '60'))
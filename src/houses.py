@@ -0,0 +1,112 @@
+import json
+import os
+from typing import NamedTuple, Tuple
+
+from config import DB_PATH, HOUSES_FILE, RETENTION_DAYS
+from schema import DEFAULT_RESOURCE
+
+# Houses and the resources that can be booked in them. Every house keeps its bookings in
+# its own SQLite file, so houses never wait for each other's write locks, and the bookings
+# of a house are further keyed by resource_id.
+#
+# houses.json looks like this, "db" is optional and defaults to bookings_<id>.db next to DB_PATH,
+# "retention_days" is optional and defaults to RETENTION_DAYS:
+# [
+#     {"id": "lenina", "name": "Ленина 5", "db": "bookings.db", "retention_days": 30, "resources": [
+#         {"id": "washer", "name": "Стиральная машина"},
+#         {"id": "dryer", "name": "Сушилка"}
+#     ]}
+# ]
+
+
+class Resource(NamedTuple):
+    id: str
+    name: str
+
+
+class House(NamedTuple):
+    id: str
+    name: str
+    db_path: str
+    resources: Tuple[Resource, ...]
+    # Bookings that started this many days ago are archived
+    retention_days: int = RETENTION_DAYS
+
+    def resource(self, resource_id: str) -> Resource:
+        for resource in self.resources:
+            if resource.id == resource_id:
+                return resource
+        raise KeyError(resource_id)
+
+
+# Telegram allows 64 bytes of callback data. The longest buttons are page_all_n_<house>_<start>_<id>
+# with 44 bytes besides the house id, and wait_ and slot_<house>_<resource>_<start>_<minutes> with
+# up to 24 bytes besides the two ids, so all of them fit with ids of up to 16 bytes.
+MAX_ID_BYTES = 16
+
+
+def _check_id(id: str) -> None:
+    # Ids end up in callback data, which is split on '_'
+    if '_' in id:
+        raise ValueError(f"House and resource ids must not contain '_': {id}")
+    if not id or len(id.encode('utf-8')) > MAX_ID_BYTES:
+        raise ValueError(f"House and resource ids must be 1 to {MAX_ID_BYTES} bytes long: {id}")
+
+
+# Used when there is no houses.json, the bookings made before houses existed live here
+DEFAULT_HOUSE = House('main', 'Дом', DB_PATH, (Resource(DEFAULT_RESOURCE, 'Стиральная машина'),))
+
+
+def load_houses(path: str = HOUSES_FILE) -> dict:
+    if not os.path.exists(path):
+        return {DEFAULT_HOUSE.id: DEFAULT_HOUSE}
+
+    with open(path, encoding='utf-8') as file:
+        entries = json.load(file)
+
+    houses = {}
+    for entry in entries:
+        _check_id(entry['id'])
+        for resource in entry['resources']:
+            _check_id(resource['id'])
+        db_path = entry.get('db') or os.path.join(os.path.dirname(DB_PATH), f"bookings_{entry['id']}.db")
+        resources = tuple(Resource(resource['id'], resource['name']) for resource in entry['resources'])
+        if not resources:
+            raise ValueError(f"House {entry['id']} has no resources")
+        houses[entry['id']] = House(entry['id'], entry['name'], db_path, resources,
+                                    int(entry.get('retention_days', RETENTION_DAYS)))
+    if not houses:
+        raise ValueError(f"{path} lists no houses")
+    return houses
+
+
+HOUSES = load_houses()
+
+
+def get_house(house_id: str) -> House:
+    return HOUSES[house_id]
+
+
+def resolve(house_id, resource_id) -> Tuple[House, Resource]:
+    """Returns the house and resource a user picked, or the first ones if the pick is missing or outdated."""
+    house = HOUSES.get(house_id) or next(iter(HOUSES.values()))
+    try:
+        return house, house.resource(resource_id)
+    except KeyError:
+        return house, house.resources[0]
+
+
+def label(house_id: str, resource_id: str) -> str:
+    """' (house, resource)' for the messages, leaving out what there is only one of."""
+    house = HOUSES.get(house_id)
+    if house is None:
+        return ''
+    parts = []
+    if len(HOUSES) > 1:
+        parts.append(house.name)
+    if len(house.resources) > 1:
+        try:
+            parts.append(house.resource(resource_id).name)
+        except KeyError:
+            parts.append(resource_id)
+    return f" ({', '.join(parts)})" if parts else ''
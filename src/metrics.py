@@ -0,0 +1,207 @@
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from telegram.utils.request import Request
+
+from config import METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Metrics in the Prometheus text format, served on http://METRICS_LISTEN:METRICS_PORT/metrics.
+# Every metric has at most one label, which is all the bot needs.
+
+_registry = []
+
+
+class Histogram:
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name: str, help: str, label: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # label value -> [count per bucket, sum, count]
+        self._series = defaultdict(lambda: [[0] * len(buckets), 0.0, 0])
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, label_value: str = '') -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series[label_value]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, label_value: str = ''):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, label_value)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = {label_value: (list(buckets), total, count)
+                      for label_value, (buckets, total, count) in self._series.items()}
+        for label_value, (buckets, total, count) in sorted(series.items()):
+            labels = f'{self.label}="{label_value}",'
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                yield f'{self.name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+            yield f'{self.name}_bucket{{{labels}le="+Inf"}} {count}'
+            yield f'{self.name}_sum{{{labels[:-1]}}} {total}'
+            yield f'{self.name}_count{{{labels[:-1]}}} {count}'
+
+    def totals(self) -> dict:
+        """{label value: (count, sum)} of the observations so far."""
+        with self._lock:
+            return {label_value: (count, total) for label_value, (_, total, count) in self._series.items()}
+
+
+class Sampled:
+    """A gauge or counter whose value is read from the rest of the bot on every scrape.
+
+    fn returns a number, or a {label value: number} dict for a labelled metric.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, fn, label: str = None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+        self.label = label
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            logger.exception("Failed to read metric %s", self.name)
+            return
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        if isinstance(value, dict):
+            for label_value, number in sorted(value.items()):
+                yield f'{self.name}{{{self.label}="{label_value}"}} {number}'
+        else:
+            yield f'{self.name} {value}'
+
+
+def render() -> str:
+    return ''.join(f'{line}\n' for metric in list(_registry) for line in metric.render())
+
+
+HANDLER_SECONDS = Histogram('booking_bot_handler_seconds', 'Time spent in the update handlers.', 'handler')
+DB_SECONDS = Histogram('booking_bot_db_seconds', 'Time spent in the database calls, including the wait for a connection.', 'query')
+DB_POOL_WAIT_SECONDS = Histogram('booking_bot_db_pool_wait_seconds', 'Time spent waiting for a pooled connection.', 'path')
+DB_LOCK_WAIT_SECONDS = Histogram('booking_bot_db_lock_wait_seconds', 'Time spent waiting for the write lock of a database.', 'path')
+TELEGRAM_SECONDS = Histogram('booking_bot_telegram_api_seconds', 'Duration of the Bot API calls.', 'method')
+REMINDER_LAG_SECONDS = Histogram('booking_bot_reminder_lag_seconds',
+                                 'Delay from the due time of a reminder to handing it to the outbox.', 'kind')
+
+
+def timed(histogram: Histogram = HANDLER_SECONDS):
+    """Decorator recording the duration of every call in the histogram, labelled with the function name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimedRequest(Request):
+    """The Bot's HTTP client, timing every Bot API call by method."""
+
+    def post(self, url: str, data, timeout: float = None):
+        with TELEGRAM_SECONDS.time(url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+def profile(seconds: float, interval: float) -> str:
+    """Samples the stacks of all threads for seconds and returns them in the folded format of flamegraph.pl."""
+    stacks = Counter()
+    own_thread = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = ';'.join(f'{entry.name} ({entry.filename.rsplit("/", 1)[-1]}:{entry.lineno})'
+                             for entry in traceback.extract_stack(frame))
+            stacks[stack] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+class MetricsServer:
+    """Serves /metrics, and /profile?seconds=10&interval=0.01 to run the sampling profiler on demand."""
+
+    def __init__(self, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/metrics':
+                    self._answer(200, render(), 'text/plain; version=0.0.4')
+                elif url.path == '/profile':
+                    params = {key: float(values[0]) for key, values in parse_qs(url.query).items()}
+                    seconds = min(params.get('seconds', 10), 300)
+                    self._answer(200, profile(seconds, max(params.get('interval', 0.01), 0.001)), 'text/plain')
+                else:
+                    self._answer(404, '', 'text/plain')
+
+            def _answer(self, status: int, body: str, content_type: str) -> None:
+                data = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+        self.server = Server((listen, port), Handler)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        logger.info("Serving metrics on port %s", self.port)
+
+
+def start_metrics_server(listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+    """Starts the metrics endpoint unless METRICS_PORT is 0, a taken port is logged instead of failing."""
+    if not port:
+        return None
+    try:
+        server = MetricsServer(listen, port)
+    except OSError:
+        logger.warning("Can't serve metrics on %s:%s", listen, port, exc_info=True)
+        return None
+    server.start()
+    return server
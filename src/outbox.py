@@ -0,0 +1,219 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config import OUTBOX_WORKERS, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average and bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long to wait before it may be used."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_full(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+class _Pending:
+    """A queued message and how far its sending got."""
+
+    __slots__ = ('chat_id', 'text', 'kwargs', 'enqueued_at', 'attempt', 'reserved')
+
+    def __init__(self, chat_id, text: str, kwargs: dict, enqueued_at: float):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.enqueued_at = enqueued_at
+        self.attempt = 0
+        # A token of the chat's bucket is already taken for the next attempt
+        self.reserved = False
+
+
+class Outbox:
+    """Queue of outgoing messages sent by a pool of worker threads.
+
+    Messages to the same chat always go through the same worker, so they keep their order.
+    Sending respects a global and a per-chat token bucket, matching Telegram's flood limits,
+    and is retried on RetryAfter and network errors. A chat that has to wait for its bucket
+    or a retry is put aside with its messages until it is due, so the worker goes on with the
+    other chats instead of sleeping. send_message() only enqueues, so handlers and the
+    reminder engine never wait for the Bot API.
+    """
+
+    # Burst sizes of the buckets. Burst plus one second of refill stays within the limits
+    # for any rolling second, e.g. 5 + 25 <= 30 messages globally.
+    GLOBAL_BURST = 5
+    CHAT_BURST = 2
+
+    # Per-chat buckets are dropped once this many exist and they are full again
+    MAX_IDLE_CHAT_BUCKETS = 10000
+
+    def __init__(self, workers: int = OUTBOX_WORKERS, global_rate: float = OUTBOX_GLOBAL_RATE,
+                 chat_rate: float = OUTBOX_CHAT_RATE, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.bot = None
+        self.max_attempts = max_attempts
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, self.GLOBAL_BURST)
+        self._chat_buckets = {}
+        self._chat_buckets_lock = threading.Lock()
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._metrics = Counter()
+        self._metrics_lock = threading.Lock()
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        for number, messages in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(messages,), name=f'outbox-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        # Sends whatever is queued, then stops the workers
+        for messages in self._queues:
+            messages.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def send_message(self, chat_id, text: str, **kwargs) -> None:
+        # Handlers pass ints, reminders and the waitlist the user_id text of the DB. One chat has to
+        # get one worker and one bucket either way
+        chat_id = int(chat_id)
+        self._count('enqueued')
+        self._queues[hash(chat_id) % len(self._queues)].put((chat_id, text, kwargs, time.monotonic()))
+
+    def queue_size(self) -> int:
+        return sum(messages.qsize() for messages in self._queues)
+
+    def metrics(self) -> dict:
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics['queued'] = self.queue_size()
+        return metrics
+
+    def _count(self, name: str, value: float = 1) -> None:
+        with self._metrics_lock:
+            self._metrics[name] += value
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self._chat_buckets) >= self.MAX_IDLE_CHAT_BUCKETS:
+                    self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full()}
+                # A reply followed by the menu goes out at once, sustained traffic is limited to chat_rate
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.CHAT_BURST)
+            return bucket
+
+    def _work(self, messages: queue.Queue) -> None:
+        # Chats put aside with their messages in order, and a heap of (due, seq, chat_id), one per chat
+        waiting = {}
+        due = []
+        order = itertools.count()
+        stopping = False
+        while not (stopping and not waiting):
+            timeout = max(0.0, due[0][0] - time.monotonic()) if due else None
+            if stopping:
+                # Only the chats put aside are left to send
+                time.sleep(timeout)
+            else:
+                try:
+                    message = messages.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+                else:
+                    if message is None:
+                        stopping = True
+                    elif message[0] in waiting:
+                        waiting[message[0]].append(_Pending(*message))
+                    else:
+                        pending = deque([_Pending(*message)])
+                        delay = self._drain(pending)
+                        if delay is not None:
+                            waiting[message[0]] = pending
+                            heapq.heappush(due, (time.monotonic() + delay, next(order), message[0]))
+
+            while due and due[0][0] <= time.monotonic():
+                _, _, chat_id = heapq.heappop(due)
+                delay = self._drain(waiting[chat_id])
+                if delay is None:
+                    del waiting[chat_id]
+                else:
+                    heapq.heappush(due, (time.monotonic() + delay, next(order), chat_id))
+
+    def _drain(self, pending: deque):
+        """Sends the chat's messages in order, returns how long to wait before going on, None when all are done."""
+        while pending:
+            delay = self._deliver(pending[0])
+            if delay is not None:
+                return delay
+            message = pending.popleft()
+            self._count('latency_seconds', time.monotonic() - message.enqueued_at)
+        return None
+
+    def _deliver(self, message: _Pending):
+        """Makes one attempt, returns how long to wait before the next one, None when the message is done with."""
+        if not message.reserved:
+            delay = self._chat_bucket(message.chat_id).reserve()
+            message.reserved = True
+            if delay > 0:
+                return delay
+        message.reserved = False
+        # The global limit applies to every chat alike, waiting for it here holds nobody back unfairly
+        self.global_bucket.acquire()
+        message.attempt += 1
+        try:
+            self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.kwargs)
+            self._count('sent')
+            return None
+        except RetryAfter as e:
+            self._count('rate_limited')
+            delay = e.retry_after
+        except BadRequest:
+            logger.warning("Telegram rejected a message to %s", message.chat_id, exc_info=True)
+            delay = None
+        except NetworkError:
+            self._count('network_errors')
+            delay = min(2 ** message.attempt, 60)
+        except TelegramError:
+            # Unauthorized (the user blocked the bot) and the like, retrying won't help
+            logger.warning("Failed to send a message to %s", message.chat_id, exc_info=True)
+            delay = None
+        if delay is not None and message.attempt < self.max_attempts:
+            self._count('retried')
+            return delay
+        self._count('failed')
+        return None
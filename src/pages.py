@@ -0,0 +1,186 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import repository
+from config import PAGE_SIZE, PAGE_CACHE_SECONDS
+from houses import HOUSES, label
+from schema import to_ts
+from usernames import get_usernames
+
+# Booking lists shown a page at a time with "back" and "next" buttons.
+#
+# Pages are keyset-paginated: the callback data of a button holds the (house, start, id) of the
+# first or last booking on the page, and every house's database is asked for at most one page
+# after or before it on the (start_ts, id) index. Nothing but the rows of one page is ever
+# loaded, however long the list is, and every page stays well within Telegram's 4096 characters.
+#
+# ALL: every booking since three days ago, house after house.
+# MINE: the user's upcoming bookings in all houses, by start time.
+ALL = 'all'
+MINE = 'my'
+
+# Keyset bounds that let every row through
+FIRST = ('', 0)
+LAST = ('~', 0)
+MAX_ID = 2 ** 63 - 1
+
+CURSOR_FORMAT = '%Y%m%d%H%M'
+
+
+def _since() -> datetime:
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=3)
+
+
+def _sort_key(kind: str, house_index: int, row):
+    id, _, _, start, _, _ = row
+    return (house_index, start, id) if kind == ALL else (start, house_index, id)
+
+
+def _bound(kind: str, house_index: int, cursor, backwards: bool):
+    """The (start_ts, id) keyset bound of one house, or None if none of its rows can be on the page."""
+    if cursor is None:
+        return LAST if backwards else FIRST
+    cursor_index, start_ts, id = cursor
+    if house_index == cursor_index:
+        return start_ts, id
+    before = house_index < cursor_index
+    if kind == ALL:
+        # Houses are listed one after the other
+        if before == backwards:
+            return LAST if backwards else FIRST
+        return None
+    # By start time, ties broken by the house order
+    return (start_ts, MAX_ID) if before else (start_ts, 0)
+
+
+def fetch(kind: str, user_id, cursor, backwards: bool, limit: int = PAGE_SIZE):
+    """Returns [(house_id, row)] of the page after (or before) the cursor, and whether the list goes on past it."""
+    houses = list(HOUSES)
+    now = datetime.now()
+    candidates = []
+    for house_index, house_id in enumerate(houses):
+        bound = _bound(kind, house_index, cursor, backwards)
+        if bound is None:
+            continue
+        if kind == ALL:
+            rows = repository.bookings_since_page(house_id, _since(), bound, backwards, limit + 1)
+        else:
+            rows = repository.user_upcoming_page(house_id, user_id, now, bound, backwards, limit + 1)
+        candidates.extend((_sort_key(kind, house_index, row), house_id, row) for row in rows)
+    candidates.sort(key=lambda candidate: candidate[0], reverse=backwards)
+    page = [(house_id, row) for _, house_id, row in candidates[:limit]]
+    if backwards:
+        page.reverse()
+    return page, len(candidates) > limit
+
+
+def _cursor_data(house_id: str, row) -> str:
+    id, _, _, start, _, _ = row
+    return f'{house_id}_{start:{CURSOR_FORMAT}}_{id}'
+
+
+def parse_cursor(house_id: str, start: str, id: str):
+    """The cursor of a button's callback data, raises ValueError if it is malformed or the house is gone."""
+    house_index = list(HOUSES).index(house_id)
+    return house_index, to_ts(datetime.strptime(start, CURSOR_FORMAT)), int(id)
+
+
+def _render_all(page) -> str:
+    usernames = get_usernames(row[1] for _, row in page)
+    lines = []
+    current_house = None
+    for house_id, (_, user_id, resource_id, start, end, _) in page:
+        house = HOUSES[house_id]
+        if len(HOUSES) > 1 and house_id != current_house:
+            lines.append(f"{house.name}:")
+            current_house = house_id
+        username = usernames.get(str(user_id))
+        user = f"@{username}" if username else user_id
+        resource = ''
+        if len(house.resources) > 1:
+            resource_names = {resource.id: resource.name for resource in house.resources}
+            resource = f" ({resource_names.get(resource_id, resource_id)})"
+        lines.append(f"{user} - с {start:%d.%m.%Y %H:%M} до {end:%d.%m.%Y %H:%M}{resource}")
+    return '\n'.join(lines)
+
+
+def _render_mine(page) -> str:
+    lines = ["Твои стирки:"]
+    for house_id, (_, _, resource_id, start, end, rule_id) in page:
+        repeats = " 🔁" if rule_id is not None else ""
+        lines.append(f"С {start:%d.%m.%Y %H:%M} до {end:%d.%m.%Y %H:%M}{label(house_id, resource_id)}{repeats}")
+    return '\n'.join(lines)
+
+
+def render(kind: str, user_id, cursor=None, backwards: bool = False):
+    """Returns the (text, reply_markup) of a page, text is None if the list is empty."""
+    page, more = fetch(kind, user_id, cursor, backwards)
+    if not page:
+        if cursor is None:
+            return None, None
+        # The bookings past the cursor are gone meanwhile, start over
+        return render(kind, user_id)
+
+    text = _render_all(page) if kind == ALL else _render_mine(page)
+    has_previous = more if backwards else cursor is not None
+    has_next = True if backwards else more
+    buttons = []
+    if has_previous:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'page_{kind}_p_{_cursor_data(*page[0])}'))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Дальше ➡️", callback_data=f'page_{kind}_n_{_cursor_data(*page[-1])}'))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+class PageCache:
+    """Rendered pages, dropped when a booking of the list changes and after max_age seconds.
+
+    Pages are grouped by list: the list of all bookings is shared, the users' own lists are
+    kept per user. At most max_lists lists are kept, the least recently used go first.
+    """
+
+    def __init__(self, max_age: float = PAGE_CACHE_SECONDS, max_lists: int = 1000):
+        self.max_age = max_age
+        self.max_lists = max_lists
+        self._lists = OrderedDict()
+        # Bumped by every invalidation, so a page rendered from rows read before it isn't stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def page(self, kind: str, user_id, cursor=None, backwards: bool = False):
+        list_key = (kind, user_id if kind == MINE else None)
+        page_key = (cursor, backwards)
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            pages = self._lists.get(list_key)
+            if pages is not None:
+                self._lists.move_to_end(list_key)
+                cached = pages.get(page_key)
+                if cached is not None and now - cached[0] < self.max_age:
+                    return cached[1]
+
+        rendered = render(kind, user_id, cursor, backwards)
+        with self._lock:
+            if generation != self._generation:
+                return rendered
+            pages = self._lists.setdefault(list_key, {})
+            pages[page_key] = (now, rendered)
+            self._lists.move_to_end(list_key)
+            while len(self._lists) > self.max_lists:
+                self._lists.popitem(last=False)
+        return rendered
+
+    def invalidate(self, user_id) -> None:
+        # A booking of the user was made or cancelled
+        with self._lock:
+            self._generation += 1
+            self._lists.pop((ALL, None), None)
+            self._lists.pop((MINE, user_id), None)
+
+
+page_cache = PageCache()
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from apscheduler.jobstores.base import JobLookupError
+
+import repository
+from houses import HOUSES
+from config import REMINDER_CATCH_UP_MINUTES
+from metrics import REMINDER_LAG_SECONDS
+
+logger = logging.getLogger(__name__)
+
+START = 'start'
+END = 'end'
+
+# The start reminder goes out this long before the booking starts
+START_REMINDER_LEAD = timedelta(minutes=15)
+
+JOB_ID = 'reminders'
+
+
+class ReminderEngine:
+    """Sends the start and end reminders of the bookings at their exact fire times.
+
+    Upcoming reminders are kept in a heap keyed by fire time, and a single date job on the
+    scheduler is armed for the earliest one, so nothing touches the DB between reminders.
+    The heap is loaded from the DB on start (catching up on recently missed reminders) and
+    kept current through booking_created/booking_cancelled. Every reminder is claimed in the
+    sent_reminders table before it is sent, which makes sending idempotent.
+
+    Booking ids are only unique within a house's database, so bookings are keyed by
+    (house_id, booking_id) here.
+    """
+
+    def __init__(self, scheduler, catch_up: timedelta = timedelta(minutes=REMINDER_CATCH_UP_MINUTES)):
+        self.scheduler = scheduler
+        self.catch_up = catch_up
+        self.sender = None
+        self._heap = []
+        # Live bookings by id, a heap entry whose booking isn't here anymore is skipped
+        self._bookings = {}
+        self._counter = itertools.count()
+        self._armed_at = None
+        self._lock = threading.RLock()
+
+    def start(self, sender) -> None:
+        # sender is anything with Bot.send_message's signature, normally the Outbox
+        self.sender = sender
+        self.reload()
+
+    def reload(self) -> None:
+        now = datetime.now()
+        rows = [((house_id, booking_id), user_id, start, end) for house_id in HOUSES
+                for booking_id, user_id, _, start, end in repository.bookings_ending_after(house_id, now - self.catch_up)]
+        with self._lock:
+            self._heap = []
+            self._bookings = {}
+            for key, user_id, start, end in rows:
+                self._add(now, key, user_id, start, end, catch_up=True)
+            self._arm(now)
+        logger.info("Loaded %s pending reminders", len(self._heap))
+
+    def _push(self, fire_at: datetime, kind: str, key) -> None:
+        heapq.heappush(self._heap, (fire_at, next(self._counter), kind, key))
+
+    def _add(self, now: datetime, key, user_id, start: datetime, end: datetime, catch_up: bool) -> None:
+        earliest = now - self.catch_up if catch_up else now
+        self._bookings[key] = (user_id, start, end)
+        # A missed start reminder is only worth sending while the booking hasn't started yet
+        if start - START_REMINDER_LEAD >= earliest and start > now:
+            self._push(start - START_REMINDER_LEAD, START, key)
+        if end >= earliest:
+            self._push(end, END, key)
+
+    def _arm(self, now: datetime) -> None:
+        while self._heap and self._heap[0][3] not in self._bookings:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            if self._armed_at is not None:
+                try:
+                    self.scheduler.remove_job(JOB_ID)
+                except JobLookupError:
+                    # Already fired, _fire is waiting for the lock
+                    pass
+                self._armed_at = None
+            return
+
+        fire_at = max(self._heap[0][0], now)
+        if fire_at != self._armed_at:
+            self.scheduler.add_job(self._fire, 'date', run_date=fire_at, id=JOB_ID,
+                                   replace_existing=True, misfire_grace_time=None, coalesce=True)
+            self._armed_at = fire_at
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def booking_created(self, house_id: str, booking_id, user_id, start: datetime, end: datetime) -> None:
+        now = datetime.now()
+        with self._lock:
+            self._add(now, (house_id, booking_id), user_id, start, end, catch_up=False)
+            self._arm(now)
+
+    def booking_cancelled(self, house_id: str, booking_id) -> None:
+        with self._lock:
+            self._bookings.pop((house_id, booking_id), None)
+            self._arm(datetime.now())
+
+    def _fire(self) -> None:
+        now = datetime.now()
+        due = []
+        with self._lock:
+            # The job that called us is gone once a date trigger has fired
+            self._armed_at = None
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, _, kind, key = heapq.heappop(self._heap)
+                booking = self._bookings.get(key)
+                if booking is None:
+                    continue
+                if kind == END:
+                    del self._bookings[key]
+                due.append((fire_at, kind, key, booking))
+            self._arm(now)
+
+        for fire_at, kind, (house_id, booking_id), (user_id, start, end) in due:
+            if not repository.claim_reminder(house_id, booking_id, kind, now):
+                continue
+            try:
+                self.send(kind, user_id, start, end)
+                REMINDER_LAG_SECONDS.observe((datetime.now() - fire_at).total_seconds(), kind)
+            except Exception:
+                logger.exception("Failed to send the %s reminder of booking %s/%s", kind, house_id, booking_id)
+
+    def send(self, kind: str, user_id, start: datetime, end: datetime) -> None:
+        if kind == START:
+            self.sender.send_message(chat_id=user_id, text=f"Напоминание: Твоя стирка начнется в {start:%H:%M}")
+        else:
+            self.sender.send_message(chat_id=user_id, text=f"Твоя стирка закончилась в {end:%H:%M}")
@@ -1,58 +1,46 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
-import pytz
-import sqlite3
-import datetime
 import logging
+import signal
 from telegram import Bot
+from config import BOT_TOKEN, TELEGRAM_API_URL, REMINDER_SYNC_MINUTES, OUTBOX_WORKERS
+from reminders import ReminderEngine
+from outbox import Outbox
+from metrics import Sampled, TimedRequest, start_metrics_server
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token='KEY')
+# The bot sends the reminders itself. This service is only needed when the reminders
+# should run in a separate process, it doesn't see booking events and reloads the
+# pending reminders from the DB every REMINDER_SYNC_MINUTES instead.
 
-# Function to send start reminders
-def send_start_reminders():
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
+if not BOT_TOKEN:
+    raise SystemExit("BOT_TOKEN is not set, export the token you've received from the BotFather")
 
-    now = datetime.datetime.now()
+bot = Bot(token=BOT_TOKEN, base_url=f'{TELEGRAM_API_URL}/bot', request=TimedRequest(con_pool_size=OUTBOX_WORKERS + 1))
 
-    time_in_15_min = now + datetime.timedelta(minutes=15)
+# Initialize the scheduler, in local time like the booking timestamps
+scheduler = BlockingScheduler()
 
-    # Retrieve bookings that are due to start in 15 minutes on the same day
-    c.execute("SELECT * FROM bookings WHERE start_booking_date = ? AND start_time = ?", (now.strftime('%d.%m.%Y'), time_in_15_min.strftime('%H:%M')))
-    bookings = c.fetchall()
+# Reminders for a popular slot go out in parallel without hitting the flood limits
+outbox = Outbox()
+outbox.start(bot)
 
-    # Send a reminder for each booking
-    for booking in bookings:
-        id, user_id, _, _, start_time, end_time = booking
-        bot.send_message(chat_id=user_id, text=f"Напоминание: Твоя стирка начнется в {start_time}")
+reminder_engine = ReminderEngine(scheduler)
+reminder_engine.start(outbox)
 
-    conn.close()
+# Pick up bookings made and cancelled through the bot
+scheduler.add_job(reminder_engine.reload, 'interval', minutes=REMINDER_SYNC_MINUTES)
 
-# Function to send end reminders
-def send_end_reminders():
-    conn = sqlite3.connect('bookings.db')
-    c = conn.cursor()
+Sampled('booking_bot_scheduler_jobs', 'Jobs waiting in the scheduler.', 'gauge', lambda: len(scheduler.get_jobs()))
+Sampled('booking_bot_reminders_pending', 'Reminders waiting for their time.', 'gauge', reminder_engine.pending)
+Sampled('booking_bot_outbox_queued', 'Messages waiting in the outbox.', 'gauge', outbox.queue_size)
+start_metrics_server()
 
-    now = datetime.datetime.now()
-
-    c.execute("SELECT * FROM bookings WHERE end_booking_date = ? AND end_time = ?", (now.strftime('%d.%m.%Y'), now.strftime('%H:%M')))
-    bookings = c.fetchall()
-    
-    for booking in bookings:
-        id, user_id, _, _, start_time, end_time = booking
-        bot.send_message(chat_id=user_id, text=f"Твоя стирка закончилась в {end_time}")
-
-    conn.close()
-
-# Initialize the scheduler
-scheduler = BlockingScheduler(timezone=pytz.utc)
-
-# Add a job to send start reminders every minute
-scheduler.add_job(send_start_reminders, 'interval', minutes=1)
-
-# Add a job to send end reminders every minute
-scheduler.add_job(send_end_reminders, 'interval', minutes=1)
+# Stop on Ctrl+C or SIGTERM. The reminders that are due finish first, and the queued ones are sent
+# before exiting, they are already marked as sent and would be lost otherwise
+for signum in (signal.SIGINT, signal.SIGTERM):
+    signal.signal(signum, lambda *args: scheduler.shutdown())
 
 scheduler.start()
+outbox.stop()
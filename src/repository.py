@@ -0,0 +1,740 @@
+import json
+import sqlite3
+import zlib
+import queue
+import threading
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from config import DB_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT
+from schema import migrate, to_ts, from_ts, split_by_hour, MAX_BOOKING_SPAN, DATE_FORMAT, TIME_FORMAT
+from houses import HOUSES, get_house
+from metrics import timed, DB_SECONDS, DB_POOL_WAIT_SECONDS, DB_LOCK_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Thread-safe pool of long-lived SQLite connections.
+
+    Connections are opened lazily, in WAL mode and with a busy timeout, so readers never
+    block the writer and concurrent writers wait instead of failing with 'database is locked'.
+    Each connection keeps its compiled statements cached, so the module-level SQL below is
+    only prepared once per connection.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, busy_timeout: float = DB_BUSY_TIMEOUT):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._migrate_lock = threading.Lock()
+        self._migrated = False
+        for _ in range(size):
+            self._idle.put(None)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode, transactions are started explicitly in transaction()
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        # Only takes effect in a new database, existing ones are switched by schema.py
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        conn.execute("PRAGMA foreign_keys=ON")
+
+        with self._migrate_lock:
+            if not self._migrated:
+                migrate(conn)
+                self._migrated = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with DB_POOL_WAIT_SECONDS.time(self.path):
+            conn = self._idle.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            yield conn
+        finally:
+            if conn is not None and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        # BEGIN IMMEDIATE takes the write lock up front, use it for read-then-write sequences
+        with self.connection() as conn:
+            if immediate:
+                # Waits in the busy handler while another connection holds the write lock
+                with DB_LOCK_WAIT_SECONDS.time(self.path):
+                    conn.execute("BEGIN IMMEDIATE")
+            else:
+                conn.execute("BEGIN")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """Returns up to pages free pages to the file system, returns how many are still free."""
+        with self.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # A database created before the pragma needs one full VACUUM to switch, which holds the
+                # write lock for the whole rewrite. That is left to schema.py, run while the bot is stopped
+                logger.warning("Incremental vacuum is off in %s, run schema.py while the bot is stopped to enable it",
+                               self.path)
+                return conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # execute() would only step it once, freeing a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            # The file only shrinks once the WAL is checkpointed, PASSIVE doesn't wait for readers
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+            return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def close(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+# Houses whose resources were written to their database in this process
+_synced_houses = set()
+
+
+def get_pool(path: str = DB_PATH) -> ConnectionPool:
+    """Returns the pool of the database file at path, DB_PATH holds the tables shared by all houses."""
+    pool = _pools.get(path)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path)
+    return pool
+
+
+def house_pool(house_id: str) -> ConnectionPool:
+    house = get_house(house_id)
+    pool = get_pool(house.db_path)
+    if house.id not in _synced_houses:
+        with _pool_lock:
+            if house.id not in _synced_houses:
+                resources = [(resource.id, resource.name) for resource in house.resources]
+                # Only write when houses.json changed, so a restart doesn't wait for the write lock
+                with pool.connection() as conn:
+                    stored = set(conn.execute(SELECT_RESOURCES).fetchall())
+                if not stored.issuperset(resources):
+                    with pool.transaction() as conn:
+                        conn.executemany(UPSERT_RESOURCE, resources)
+                _synced_houses.add(house.id)
+    return pool
+
+
+SELECT_RESOURCES = "SELECT id, name FROM resources"
+
+UPSERT_RESOURCE = """
+    INSERT INTO resources (id, name) VALUES (?, ?)
+    ON CONFLICT (id) DO UPDATE SET name = excluded.name
+"""
+
+# Bookings of the resource whose 30-minute buffer reaches into [window_start, window_end)
+SELECT_BOOKINGS_IN_WINDOW = """
+    SELECT start_ts, end_ts
+    FROM bookings
+    WHERE resource_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ?
+    ORDER BY start_ts
+"""
+
+SELECT_CONFLICT = """
+    SELECT id FROM bookings
+    WHERE resource_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ?
+    LIMIT 1
+"""
+
+INSERT_BOOKING = """
+    INSERT INTO bookings (user_id, resource_id, start_booking_date, end_booking_date, start_time, end_time, start_ts, end_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SELECT_USER_UPCOMING = """
+    SELECT id, resource_id, start_booking_date, end_booking_date, start_time, end_time, rule_id
+    FROM bookings
+    WHERE user_id = ? AND start_ts >= ? AND end_ts > ?
+    ORDER BY start_ts
+"""
+
+# Pages of bookings in (start_ts, id) order after or before a cursor, {} is the filter of the list
+SELECT_PAGE_AFTER = """
+    SELECT id, user_id, resource_id, start_ts, end_ts, rule_id
+    FROM bookings
+    WHERE {} AND (start_ts, id) > (?, ?)
+    ORDER BY start_ts, id
+    LIMIT ?
+"""
+
+SELECT_PAGE_BEFORE = """
+    SELECT id, user_id, resource_id, start_ts, end_ts, rule_id
+    FROM bookings
+    WHERE {} AND (start_ts, id) < (?, ?)
+    ORDER BY start_ts DESC, id DESC
+    LIMIT ?
+"""
+
+SINCE_FILTER = "start_ts >= ?"
+
+USER_UPCOMING_FILTER = "user_id = ? AND start_ts >= ? AND end_ts > ?"
+
+SELECT_BOOKINGS_ENDING_AFTER = """
+    SELECT id, user_id, resource_id, start_ts, end_ts
+    FROM bookings
+    WHERE start_ts >= ? AND end_ts >= ?
+"""
+
+# Inserts nothing if the reminder was already sent or the booking was cancelled meanwhile
+CLAIM_REMINDER = """
+    INSERT OR IGNORE INTO sent_reminders (booking_id, kind, sent_at)
+    SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM bookings WHERE id = ?)
+"""
+
+SELECT_BOOKING_INTERVAL = "SELECT resource_id, start_ts, end_ts FROM bookings WHERE id = ? AND user_id = ?"
+
+SELECT_BOOKING_FOR_RULE = "SELECT resource_id, start_ts, end_ts, rule_id FROM bookings WHERE id = ? AND user_id = ?"
+
+# Which of the wanted occurrences (n, scan from, buffered end, buffered start) overlap a booking,
+# one index range scan on (resource_id, start_ts, end_ts) per occurrence
+SELECT_OCCURRENCE_CONFLICTS = """
+    WITH wanted (n, scan_from, buffered_end, buffered_start) AS (VALUES {})
+    SELECT DISTINCT wanted.n
+    FROM wanted JOIN bookings
+      ON bookings.resource_id = ? AND bookings.start_ts >= wanted.scan_from
+     AND bookings.start_ts < wanted.buffered_end AND bookings.end_ts > wanted.buffered_start
+"""
+
+# Which of the wanted occurrences are held for another user on the waitlist, like SELECT_HELD_CONFLICT
+SELECT_OCCURRENCE_HELD = """
+    WITH wanted (n, scan_from, buffered_end, buffered_start) AS (VALUES {})
+    SELECT DISTINCT wanted.n
+    FROM wanted JOIN waitlist
+      ON waitlist.resource_id = ? AND waitlist.start_ts >= wanted.scan_from
+     AND waitlist.start_ts < wanted.buffered_end AND waitlist.end_ts > wanted.buffered_start
+     AND waitlist.held_until > ? AND waitlist.user_id != ?
+"""
+
+INSERT_RULE = """
+    INSERT INTO booking_rules (user_id, resource_id, first_start_ts, last_start_ts, interval_days, count, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_OCCURRENCE = """
+    INSERT INTO bookings (user_id, resource_id, start_booking_date, end_booking_date, start_time, end_time, start_ts, end_ts, rule_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SET_BOOKING_RULE = "UPDATE bookings SET rule_id = ? WHERE id = ?"
+
+SELECT_RULE_BOOKINGS_FROM = """
+    SELECT id, resource_id, start_ts, end_ts FROM bookings
+    WHERE rule_id = ? AND start_ts >= ?
+    ORDER BY start_ts
+"""
+
+SELECT_RULE = "SELECT id FROM booking_rules WHERE id = ? AND user_id = ?"
+
+DELETE_RULE = "DELETE FROM booking_rules WHERE id = ?"
+
+DETACH_RULE = "UPDATE bookings SET rule_id = NULL WHERE rule_id = ?"
+
+DELETE_RULES_BEFORE = "DELETE FROM booking_rules WHERE last_start_ts < ?"
+
+INSERT_WAITER = """
+    INSERT OR IGNORE INTO waitlist (user_id, resource_id, start_ts, end_ts, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# Waiters whose time may have become free, the time overlaps the buffered freed interval.
+# First come first served.
+SELECT_WAITERS_OF_FREED = """
+    SELECT id, user_id, start_ts, end_ts FROM waitlist
+    WHERE resource_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? AND start_ts > ? AND held_until IS NULL
+    ORDER BY id
+"""
+
+# A time held for another user on the waitlist, it is as good as booked until the hold runs out
+SELECT_HELD_CONFLICT = """
+    SELECT id FROM waitlist
+    WHERE resource_id = ? AND start_ts >= ? AND start_ts < ? AND end_ts > ? AND held_until > ? AND user_id != ?
+    LIMIT 1
+"""
+
+HOLD_WAITER = "UPDATE waitlist SET held_until = ? WHERE id = ?"
+
+SELECT_WAITER = "SELECT user_id, resource_id, start_ts, end_ts, held_until FROM waitlist WHERE id = ?"
+
+DELETE_WAITER = "DELETE FROM waitlist WHERE id = ?"
+
+SELECT_HELD_WAITERS = "SELECT id, held_until FROM waitlist WHERE held_until IS NOT NULL"
+
+DELETE_WAITERS_BEFORE = "DELETE FROM waitlist WHERE id IN (SELECT id FROM waitlist WHERE end_ts < ? LIMIT ?)"
+
+DELETE_BOOKING = "DELETE FROM bookings WHERE id = ?"
+
+DELETE_USER_BOOKING = "DELETE FROM bookings WHERE id = ? AND user_id = ?"
+
+SELECT_BOOKINGS_BEFORE = """
+    SELECT id, user_id, resource_id, start_ts, end_ts
+    FROM bookings
+    WHERE start_ts < ?
+    ORDER BY start_ts
+    LIMIT ?
+"""
+
+INSERT_ARCHIVE = """
+    INSERT INTO bookings_archive (first_start_ts, last_start_ts, count, data)
+    VALUES (?, ?, ?, ?)
+"""
+
+SELECT_ARCHIVE = "SELECT data FROM bookings_archive WHERE last_start_ts >= ? AND first_start_ts < ? ORDER BY id"
+
+DELETE_REMINDERS_OF_BOOKING = "DELETE FROM sent_reminders WHERE booking_id = ?"
+
+SELECT_USERNAMES = "SELECT user_id, username, updated_at FROM usernames WHERE user_id IN ({})"
+
+UPSERT_USERNAME = """
+    INSERT INTO usernames (user_id, username, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, updated_at = excluded.updated_at
+"""
+
+ADD_USAGE_MINUTES = """
+    INSERT INTO usage_hourly (resource_id, hour_ts, minutes) VALUES (?, ?, ?)
+    ON CONFLICT (resource_id, hour_ts) DO UPDATE SET minutes = minutes + excluded.minutes
+"""
+
+ADD_USAGE_COUNTS = """
+    INSERT INTO usage_daily (resource_id, day, booked, cancelled) VALUES (?, ?, ?, ?)
+    ON CONFLICT (resource_id, day) DO UPDATE SET booked = booked + excluded.booked, cancelled = cancelled + excluded.cancelled
+"""
+
+# Booked minutes by weekday (0 is Sunday) and hour, summed over the resources
+SELECT_USAGE_BY_WEEKDAY_HOUR = """
+    SELECT CAST(strftime('%w', hour_ts) AS INTEGER), CAST(substr(hour_ts, 12, 2) AS INTEGER), SUM(minutes)
+    FROM usage_hourly
+    WHERE hour_ts >= ? AND hour_ts < ?
+    GROUP BY 1, 2
+"""
+
+SELECT_USAGE_COUNTS = """
+    SELECT COALESCE(SUM(booked), 0), COALESCE(SUM(cancelled), 0)
+    FROM usage_daily
+    WHERE day >= ? AND day < ?
+"""
+
+SELECT_USAGE_HOURLY = """
+    SELECT resource_id, hour_ts, minutes
+    FROM usage_hourly
+    WHERE hour_ts >= ? AND hour_ts < ? AND minutes > 0
+    ORDER BY hour_ts, resource_id
+"""
+
+SELECT_SESSION = "SELECT data FROM sessions WHERE user_id = ? AND updated_at >= ?"
+
+UPSERT_SESSION = """
+    INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+"""
+
+DELETE_SESSION = "DELETE FROM sessions WHERE user_id = ?"
+
+DELETE_SESSIONS_BEFORE = """
+    DELETE FROM sessions
+    WHERE user_id IN (SELECT user_id FROM sessions WHERE updated_at < ? LIMIT ?)
+"""
+
+# SQLite's default limit of host parameters per statement
+MAX_VARIABLES = 999
+
+
+def _add_usage(conn, resource_id: str, start: datetime, end: datetime, sign: int) -> None:
+    # Booking (sign 1) or cancellation (sign -1) applied to the running usage aggregates
+    conn.executemany(ADD_USAGE_MINUTES, [(resource_id, to_ts(hour), sign * minutes)
+                                         for hour, minutes in split_by_hour(start, end)])
+    conn.execute(ADD_USAGE_COUNTS, (resource_id, start.date().isoformat(), 1 if sign > 0 else 0, 1 if sign < 0 else 0))
+
+
+@timed(DB_SECONDS)
+def bookings_in_window(house_id: str, resource_id: str, window_start: datetime, window_end: datetime, buffer: timedelta):
+    # The lower bound on start_ts keeps it an index range scan over the resource's rows
+    with house_pool(house_id).connection() as conn:
+        return conn.execute(SELECT_BOOKINGS_IN_WINDOW, (
+            resource_id,
+            to_ts(window_start - buffer - MAX_BOOKING_SPAN),
+            to_ts(window_end + buffer),
+            to_ts(window_start - buffer),
+        )).fetchall()
+
+
+def _hold_ts(moment: datetime) -> str:
+    # Holds last minutes, so they are stored to the second unlike the bookings
+    return moment.isoformat(' ', 'seconds')
+
+
+def _valid_span(start: datetime, end: datetime) -> bool:
+    # The interval queries only look MAX_BOOKING_SPAN back, a longer booking would hide overlaps
+    return start < end and end - start <= MAX_BOOKING_SPAN
+
+
+def _buffered(start: datetime, end: datetime, buffer: timedelta):
+    # Parameters of the interval queries: the lower bound of the index scan, and the buffered interval
+    return to_ts(start - buffer - MAX_BOOKING_SPAN), to_ts(end + buffer), to_ts(start - buffer)
+
+
+@timed(DB_SECONDS)
+def book(house_id: str, resource_id: str, user_id, start: datetime, end: datetime, buffer: timedelta,
+         now: datetime = None):
+    """Atomically checks the buffered interval for overlaps and inserts the booking.
+
+    Returns the new booking id, or None if the slot is taken or held for another user on the
+    waitlist. BEGIN IMMEDIATE serializes concurrent bookings of the house, and the
+    bookings_no_overlap trigger rejects anything that slips past. Also returns None for an empty
+    booking or one longer than MAX_BOOKING_SPAN, which the bounded range scans wouldn't see.
+    """
+    if not _valid_span(start, end):
+        return None
+    try:
+        with house_pool(house_id).transaction(immediate=True) as conn:
+            conflict = conn.execute(SELECT_CONFLICT, (resource_id,) + _buffered(start, end, buffer)).fetchone()
+            if conflict is not None:
+                return None
+            held = conn.execute(SELECT_HELD_CONFLICT, (resource_id,) + _buffered(start, end, buffer) + (
+                _hold_ts(now or datetime.now()), user_id)).fetchone()
+            if held is not None:
+                return None
+
+            cursor = conn.execute(INSERT_BOOKING, (
+                user_id, resource_id, start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT),
+                start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), to_ts(start), to_ts(end),
+            ))
+            _add_usage(conn, resource_id, start, end, 1)
+            return cursor.lastrowid
+    except sqlite3.IntegrityError:
+        logger.info("Booking of %s/%s %s - %s rejected by a trigger", house_id, resource_id, start, end)
+        return None
+
+
+@timed(DB_SECONDS)
+def user_upcoming_bookings(user_id, now: datetime):
+    """Returns (house_id, id, resource_id, start date, end date, start time, end time, rule_id) in every house."""
+    bookings = []
+    for house_id in HOUSES:
+        with house_pool(house_id).connection() as conn:
+            rows = conn.execute(SELECT_USER_UPCOMING, (user_id, to_ts(now - MAX_BOOKING_SPAN), to_ts(now))).fetchall()
+        bookings.extend((house_id,) + row for row in rows)
+    if len(HOUSES) > 1:
+        bookings.sort(key=lambda row: datetime.strptime(f"{row[3]} {row[5]}", f"{DATE_FORMAT} {TIME_FORMAT}"))
+    return bookings
+
+
+def _page(house_id: str, list_filter: str, params: tuple, bound, backwards: bool, limit: int):
+    sql = (SELECT_PAGE_BEFORE if backwards else SELECT_PAGE_AFTER).format(list_filter)
+    with house_pool(house_id).connection() as conn:
+        rows = conn.execute(sql, params + bound + (limit,)).fetchall()
+    return [(id, user_id, resource_id, from_ts(start_ts), from_ts(end_ts), rule_id)
+            for id, user_id, resource_id, start_ts, end_ts, rule_id in rows]
+
+
+@timed(DB_SECONDS)
+def bookings_since_page(house_id: str, since: datetime, bound, backwards: bool, limit: int):
+    """Returns up to limit (id, user_id, resource_id, start, end, rule_id) of the house's bookings that start
+    at or after since, the next ones after the (start_ts, id) bound or, backwards, the ones before it."""
+    return _page(house_id, SINCE_FILTER, (to_ts(since),), bound, backwards, limit)
+
+
+@timed(DB_SECONDS)
+def user_upcoming_page(house_id: str, user_id, now: datetime, bound, backwards: bool, limit: int):
+    """Like bookings_since_page for the user's bookings that haven't ended yet."""
+    return _page(house_id, USER_UPCOMING_FILTER, (user_id, to_ts(now - MAX_BOOKING_SPAN), to_ts(now)),
+                 bound, backwards, limit)
+
+
+@timed(DB_SECONDS)
+def bookings_ending_after(house_id: str, moment: datetime):
+    """Returns (id, user_id, resource_id, start, end) of the house's bookings that end at or after moment."""
+    with house_pool(house_id).connection() as conn:
+        rows = conn.execute(SELECT_BOOKINGS_ENDING_AFTER, (to_ts(moment - MAX_BOOKING_SPAN), to_ts(moment))).fetchall()
+    return [(id, user_id, resource_id, from_ts(start_ts), from_ts(end_ts))
+            for id, user_id, resource_id, start_ts, end_ts in rows]
+
+
+@timed(DB_SECONDS)
+def claim_reminder(house_id: str, booking_id, kind: str, now: datetime) -> bool:
+    """Marks the reminder as sent, returns False if it already was or the booking is gone."""
+    with house_pool(house_id).transaction() as conn:
+        return conn.execute(CLAIM_REMINDER, (booking_id, kind, to_ts(now), booking_id)).rowcount == 1
+
+
+@timed(DB_SECONDS)
+def delete_booking(house_id: str, booking_id, user_id):
+    """Deletes the user's booking and returns its (resource_id, start, end), or None if it was already gone or isn't theirs."""
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        row = conn.execute(SELECT_BOOKING_INTERVAL, (booking_id, user_id)).fetchone()
+        if row is None:
+            return None
+        conn.execute(DELETE_USER_BOOKING, (booking_id, user_id))
+        resource_id, start, end = row[0], from_ts(row[1]), from_ts(row[2])
+        _add_usage(conn, resource_id, start, end, -1)
+        return resource_id, start, end
+
+
+@timed(DB_SECONDS)
+def repeat_booking(house_id: str, booking_id, user_id, count: int, interval: timedelta, buffer: timedelta, now: datetime):
+    """Turns the user's booking into the first of count occurrences, interval apart.
+
+    All further occurrences are checked for conflicts and waitlist holds of other users in one
+    query each, and the free ones are inserted in the same transaction. Returns (rule_id, [(id, resource_id, start, end)] of the new occurrences,
+    [starts that were taken]), rule_id is None if all of them were taken. Returns None if the booking
+    is gone, isn't the user's, already repeats or is empty or longer than MAX_BOOKING_SPAN.
+    """
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        row = conn.execute(SELECT_BOOKING_FOR_RULE, (booking_id, user_id)).fetchone()
+        if row is None or row[3] is not None:
+            return None
+        resource_id, start, end = row[0], from_ts(row[1]), from_ts(row[2])
+        if not _valid_span(start, end):
+            return None
+        occurrences = list(enumerate((start + interval * n, end + interval * n) for n in range(1, count)))
+
+        taken = set()
+        for i in range(0, len(occurrences), MAX_VARIABLES // 4):
+            chunk = occurrences[i:i + MAX_VARIABLES // 4]
+            params = [value for n, (occurrence_start, occurrence_end) in chunk for value in (
+                n, to_ts(occurrence_start - buffer - MAX_BOOKING_SPAN), to_ts(occurrence_end + buffer),
+                to_ts(occurrence_start - buffer))]
+            values = ', '.join(['(?, ?, ?, ?)'] * len(chunk))
+            taken.update(n for n, in conn.execute(SELECT_OCCURRENCE_CONFLICTS.format(values), params + [resource_id]))
+            # Weeks held for a waiting user are as good as booked, as in book()
+            taken.update(n for n, in conn.execute(SELECT_OCCURRENCE_HELD.format(values),
+                                                  params + [resource_id, _hold_ts(now), user_id]))
+
+        taken_starts = [occurrence_start for n, (occurrence_start, _) in occurrences if n in taken]
+        free = [occurrence for n, occurrence in occurrences if n not in taken]
+        if not free:
+            return None, [], taken_starts
+
+        cursor = conn.execute(INSERT_RULE, (
+            user_id, resource_id, to_ts(start), to_ts(free[-1][0]), interval.days, count, to_ts(now)))
+        rule_id = cursor.lastrowid
+        conn.execute(SET_BOOKING_RULE, (rule_id, booking_id))
+        conn.executemany(INSERT_OCCURRENCE, [(
+            user_id, resource_id, occurrence_start.strftime(DATE_FORMAT), occurrence_end.strftime(DATE_FORMAT),
+            occurrence_start.strftime(TIME_FORMAT), occurrence_end.strftime(TIME_FORMAT),
+            to_ts(occurrence_start), to_ts(occurrence_end), rule_id,
+        ) for occurrence_start, occurrence_end in free])
+        for occurrence_start, occurrence_end in free:
+            _add_usage(conn, resource_id, occurrence_start, occurrence_end, 1)
+
+        created = [(id, resource_id, from_ts(start_ts), from_ts(end_ts)) for id, resource_id, start_ts, end_ts
+                   in conn.execute(SELECT_RULE_BOOKINGS_FROM, (rule_id, to_ts(start + interval)))]
+        return rule_id, created, taken_starts
+
+
+@timed(DB_SECONDS)
+def delete_rule(house_id: str, rule_id, user_id, now: datetime):
+    """Cancels the occurrences of the user's rule that haven't started yet and drops the rule.
+
+    Returns [(id, resource_id, start, end)] of the deleted bookings, or None if there is no such rule.
+    """
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        if conn.execute(SELECT_RULE, (rule_id, user_id)).fetchone() is None:
+            return None
+        deleted = [(id, resource_id, from_ts(start_ts), from_ts(end_ts)) for id, resource_id, start_ts, end_ts
+                   in conn.execute(SELECT_RULE_BOOKINGS_FROM, (rule_id, to_ts(now))).fetchall()]
+        conn.executemany(DELETE_BOOKING, [(id,) for id, _, _, _ in deleted])
+        for _, resource_id, start, end in deleted:
+            _add_usage(conn, resource_id, start, end, -1)
+        # The past occurrences stay as one-off bookings
+        conn.execute(DETACH_RULE, (rule_id,))
+        conn.execute(DELETE_RULE, (rule_id,))
+        return deleted
+
+
+@timed(DB_SECONDS)
+def add_waiter(house_id: str, resource_id: str, user_id, start: datetime, end: datetime, now: datetime) -> bool:
+    """Puts the user on the waitlist for the time, returns False if they already wait for it."""
+    with house_pool(house_id).transaction() as conn:
+        return conn.execute(INSERT_WAITER, (user_id, resource_id, to_ts(start), to_ts(end), to_ts(now))).rowcount == 1
+
+
+@timed(DB_SECONDS)
+def hold_freed(house_id: str, resource_id: str, start: datetime, end: datetime, buffer: timedelta,
+               now: datetime, held_until: datetime):
+    """Holds the time for the first waiters it can be booked for, now that [start, end) is free.
+
+    Every waiter whose time overlaps the freed interval is checked in the order they subscribed,
+    a waiter gets the hold if the time is free of bookings and of the holds given out before.
+    Returns [(waiter_id, user_id, start, end)] of the waiters that got a hold.
+    """
+    held = []
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        candidates = conn.execute(SELECT_WAITERS_OF_FREED, (resource_id,) + _buffered(start, end, buffer) + (
+            to_ts(now),)).fetchall()
+        for waiter_id, user_id, start_ts, end_ts in candidates:
+            # One offer per user and cancellation
+            if any(user_id == held_user for _, held_user, _, _ in held):
+                continue
+            wanted = _buffered(from_ts(start_ts), from_ts(end_ts), buffer)
+            if conn.execute(SELECT_CONFLICT, (resource_id,) + wanted).fetchone() is not None:
+                continue
+            if conn.execute(SELECT_HELD_CONFLICT, (resource_id,) + wanted + (_hold_ts(now), user_id)).fetchone() is not None:
+                continue
+            conn.execute(HOLD_WAITER, (_hold_ts(held_until), waiter_id))
+            held.append((waiter_id, user_id, from_ts(start_ts), from_ts(end_ts)))
+    return held
+
+
+@timed(DB_SECONDS)
+def waiter(house_id: str, waiter_id):
+    """Returns (user_id, resource_id, start, end, held_until) of the waitlist entry, or None if it is gone."""
+    with house_pool(house_id).connection() as conn:
+        row = conn.execute(SELECT_WAITER, (waiter_id,)).fetchone()
+    if row is None:
+        return None
+    user_id, resource_id, start_ts, end_ts, held_until = row
+    return user_id, resource_id, from_ts(start_ts), from_ts(end_ts), datetime.fromisoformat(held_until) if held_until else None
+
+
+@timed(DB_SECONDS)
+def delete_waiter(house_id: str, waiter_id) -> None:
+    with house_pool(house_id).transaction() as conn:
+        conn.execute(DELETE_WAITER, (waiter_id,))
+
+
+@timed(DB_SECONDS)
+def release_expired_hold(house_id: str, waiter_id, now: datetime):
+    """Drops the waiter if their hold ran out, returns the (resource_id, start, end) that is free again or None."""
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        row = conn.execute(SELECT_WAITER, (waiter_id,)).fetchone()
+        if row is None or row[4] is None or row[4] > _hold_ts(now):
+            return None
+        conn.execute(DELETE_WAITER, (waiter_id,))
+        return row[1], from_ts(row[2]), from_ts(row[3])
+
+
+@timed(DB_SECONDS)
+def held_waiters(house_id: str):
+    """Returns (waiter_id, held_until) of the house's waiters with a hold."""
+    with house_pool(house_id).connection() as conn:
+        return [(waiter_id, datetime.fromisoformat(held_until)) for waiter_id, held_until in conn.execute(SELECT_HELD_WAITERS)]
+
+
+@timed(DB_SECONDS)
+def delete_waiters_before(house_id: str, moment: datetime, limit: int) -> int:
+    """Deletes up to limit waitlist entries whose time ended before moment, returns how many."""
+    with house_pool(house_id).transaction() as conn:
+        return conn.execute(DELETE_WAITERS_BEFORE, (to_ts(moment), limit)).rowcount
+
+
+@timed(DB_SECONDS)
+def archive_bookings_before(house_id: str, moment: datetime, limit: int) -> int:
+    """Moves up to limit of the house's bookings that started before moment into the archive.
+
+    Returns how many were moved, a short transaction per call keeps the bot's writers waiting
+    for at most one batch.
+    """
+    with house_pool(house_id).transaction(immediate=True) as conn:
+        rows = conn.execute(SELECT_BOOKINGS_BEFORE, (to_ts(moment), limit)).fetchall()
+        if not rows:
+            return 0
+        data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode(), 9)
+        conn.execute(INSERT_ARCHIVE, (rows[0][3], rows[-1][3], len(rows), data))
+        conn.executemany(DELETE_BOOKING, [(row[0],) for row in rows])
+        conn.executemany(DELETE_REMINDERS_OF_BOOKING, [(row[0],) for row in rows])
+        # Rules with nothing left but archived occurrences
+        conn.execute(DELETE_RULES_BEFORE, (to_ts(moment),))
+        return len(rows)
+
+
+def archived_bookings(house_id: str, since: datetime, until: datetime):
+    """Yields (id, user_id, resource_id, start, end) of the archived bookings that started in [since, until)."""
+    with house_pool(house_id).connection() as conn:
+        batches = conn.execute(SELECT_ARCHIVE, (to_ts(since), to_ts(until))).fetchall()
+    for data, in batches:
+        for id, user_id, resource_id, start_ts, end_ts in json.loads(zlib.decompress(data)):
+            start = from_ts(start_ts)
+            if since <= start < until:
+                yield id, user_id, resource_id, start, from_ts(end_ts)
+
+
+@timed(DB_SECONDS)
+def usage_by_weekday_hour(house_id: str, since: datetime, until: datetime):
+    """Returns (weekday, hour, booked minutes) of the house in [since, until), weekday 0 is Sunday."""
+    with house_pool(house_id).connection() as conn:
+        return conn.execute(SELECT_USAGE_BY_WEEKDAY_HOUR, (to_ts(since), to_ts(until))).fetchall()
+
+
+@timed(DB_SECONDS)
+def usage_counts(house_id: str, since: datetime, until: datetime):
+    """Returns (booked, cancelled) for the bookings of the house that start in [since, until)."""
+    with house_pool(house_id).connection() as conn:
+        return conn.execute(SELECT_USAGE_COUNTS, (since.date().isoformat(), until.date().isoformat())).fetchone()
+
+
+@timed(DB_SECONDS)
+def usage_hourly(house_id: str, since: datetime, until: datetime):
+    """Returns (resource_id, hour, booked minutes) of the house in [since, until)."""
+    with house_pool(house_id).connection() as conn:
+        rows = conn.execute(SELECT_USAGE_HOURLY, (to_ts(since), to_ts(until))).fetchall()
+    return [(resource_id, from_ts(hour_ts), minutes) for resource_id, hour_ts, minutes in rows]
+
+
+@timed(DB_SECONDS)
+def cached_usernames(user_ids):
+    """Returns {user_id: (username, updated_at)} for the user_ids that are in the usernames table."""
+    user_ids = [str(user_id) for user_id in user_ids]
+    result = {}
+    with get_pool().connection() as conn:
+        for i in range(0, len(user_ids), MAX_VARIABLES):
+            chunk = user_ids[i:i + MAX_VARIABLES]
+            sql = SELECT_USERNAMES.format(', '.join('?' * len(chunk)))
+            for user_id, username, updated_at in conn.execute(sql, chunk):
+                result[user_id] = (username, from_ts(updated_at))
+    return result
+
+
+@timed(DB_SECONDS)
+def save_usernames(entries, updated_at: datetime) -> None:
+    """Stores {user_id: username} pairs, None for users known to have no username."""
+    with get_pool().transaction() as conn:
+        conn.executemany(UPSERT_USERNAME, [(str(user_id), username, to_ts(updated_at))
+                                           for user_id, username in entries.items()])
+
+
+@timed(DB_SECONDS)
+def load_session(user_id, since: datetime):
+    """Returns the user's stored session data if it was saved at or after since."""
+    with get_pool().connection() as conn:
+        row = conn.execute(SELECT_SESSION, (user_id, to_ts(since))).fetchone()
+    return row[0] if row else None
+
+
+@timed(DB_SECONDS)
+def save_sessions(entries, updated_at: datetime) -> None:
+    """Stores {user_id: data} pairs in one transaction, None data deletes the session."""
+    with get_pool().transaction() as conn:
+        conn.executemany(UPSERT_SESSION, [(user_id, data, to_ts(updated_at))
+                                          for user_id, data in entries.items() if data is not None])
+        conn.executemany(DELETE_SESSION, [(user_id,) for user_id, data in entries.items() if data is None])
+
+
+@timed(DB_SECONDS)
+def delete_sessions_before(moment: datetime, limit: int) -> int:
+    """Deletes up to limit sessions last changed before moment, returns how many were deleted."""
+    with get_pool().transaction() as conn:
+        return conn.execute(DELETE_SESSIONS_BEFORE, (to_ts(moment), limit)).rowcount
@@ -0,0 +1,44 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+import repository
+from config import (RETENTION_BATCH_SIZE, RETENTION_PAUSE_SECONDS, RETENTION_VACUUM_PAGES,
+                    SESSION_TTL_HOURS)
+from houses import HOUSES
+
+logger = logging.getLogger(__name__)
+
+
+def _in_batches(step, pause: float) -> int:
+    # Runs step until it has nothing left to do, every call is its own short transaction
+    # and the pause in between lets the bot's writers in
+    total = 0
+    while True:
+        done = step()
+        total += done
+        if not done:
+            return total
+        time.sleep(pause)
+
+
+def run_retention(batch_size: int = RETENTION_BATCH_SIZE, pause: float = RETENTION_PAUSE_SECONDS,
+                  vacuum_pages: int = RETENTION_VACUUM_PAGES) -> None:
+    """Archives the bookings past each house's retention, drops abandoned sessions and reclaims the freed space."""
+    now = datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    for house in HOUSES.values():
+        cutoff = today - timedelta(days=house.retention_days)
+        archived = _in_batches(lambda: repository.archive_bookings_before(house.id, cutoff, batch_size), pause)
+        # Nobody waits for a time that has passed
+        waiters = _in_batches(lambda: repository.delete_waiters_before(house.id, now, batch_size), pause)
+        free_pages = repository.house_pool(house.id).incremental_vacuum(vacuum_pages)
+        logger.info("Archived %s bookings of house %s that started before %s, dropped %s waiters, %s free pages left",
+                    archived, house.id, cutoff, waiters, free_pages)
+
+    # Abandoned conversations, they are ignored once older than SESSION_TTL_HOURS anyway
+    expired = now - timedelta(hours=SESSION_TTL_HOURS)
+    deleted = _in_batches(lambda: repository.delete_sessions_before(expired, batch_size), pause)
+    repository.get_pool().incremental_vacuum(vacuum_pages)
+    logger.info("Deleted %s abandoned sessions", deleted)
@@ -0,0 +1,307 @@
+import json
+import sqlite3
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Sortable timestamp format stored in start_ts/end_ts, e.g. '2023-06-01 18:30'
+TS_FORMAT = '%Y-%m-%d %H:%M'
+# Format that is shown to the users and kept in the legacy text columns
+DATE_FORMAT = '%d.%m.%Y'
+TIME_FORMAT = '%H:%M'
+
+# A booking never lasts longer than this (start time on the selected day, end time on the next one at the latest).
+# Used to turn "overlaps with" checks into bounded index range scans over start_ts.
+MAX_BOOKING_SPAN = timedelta(days=1)
+
+# Resource of the bookings made before there were several resources per house
+DEFAULT_RESOURCE = 'washer'
+
+
+def to_ts(dt: datetime) -> str:
+    return dt.strftime(TS_FORMAT)
+
+
+def from_ts(ts: str) -> datetime:
+    return datetime.strptime(ts, TS_FORMAT)
+
+
+def split_by_hour(start: datetime, end: datetime):
+    """Yields (start of the hour, booked minutes in it) for every hour the booking touches."""
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour < end:
+        next_hour = hour + timedelta(hours=1)
+        minutes = int((min(end, next_hour) - max(start, hour)).total_seconds() // 60)
+        if minutes:
+            yield hour, minutes
+        hour = next_hour
+
+
+def _create_bookings_table(conn):
+    # Legacy layout, kept as the starting point of the migrations
+    conn.execute('''CREATE TABLE IF NOT EXISTS bookings
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id text, start_booking_date text, end_booking_date text, start_time text, end_time text)''')
+
+
+def _add_timestamps(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(bookings)")]
+    for column in ('start_ts', 'end_ts'):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE bookings ADD COLUMN {column} text")
+
+    # Backfill the ISO timestamps from the 'DD.MM.YYYY' + 'HH:MM' text columns.
+    # Done in Python because older rows may hold unpadded times like '9:30'.
+    rows = conn.execute("""
+        SELECT id, start_booking_date, end_booking_date, start_time, end_time
+        FROM bookings
+        WHERE start_ts IS NULL OR end_ts IS NULL
+    """).fetchall()
+    for id, start_booking_date, end_booking_date, start_time, end_time in rows:
+        try:
+            start_dt = datetime.strptime(f"{start_booking_date} {start_time}", f"{DATE_FORMAT} {TIME_FORMAT}")
+            end_dt = datetime.strptime(f"{end_booking_date} {end_time}", f"{DATE_FORMAT} {TIME_FORMAT}")
+        except (TypeError, ValueError):
+            logger.warning("Skipping booking %s with malformed date/time", id)
+            continue
+        conn.execute("""
+            UPDATE bookings
+            SET start_ts = ?, end_ts = ?, start_time = ?, end_time = ?
+            WHERE id = ?
+        """, (to_ts(start_dt), to_ts(end_dt), start_dt.strftime(TIME_FORMAT), end_dt.strftime(TIME_FORMAT), id))
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_start_end ON bookings (start_ts, end_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_user_start ON bookings (user_id, start_ts)")
+
+
+def _add_overlap_trigger(conn):
+    # Last line of defence against double bookings from any writer: reject a row whose
+    # 30-minute-buffered interval overlaps an existing booking, using the (start_ts, end_ts) index
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS bookings_no_overlap
+        BEFORE INSERT ON bookings
+        WHEN EXISTS (
+            SELECT 1 FROM bookings
+            WHERE start_ts >= strftime('%Y-%m-%d %H:%M', NEW.start_ts, '-30 minutes', '-1 day')
+              AND start_ts < strftime('%Y-%m-%d %H:%M', NEW.end_ts, '+30 minutes')
+              AND end_ts > strftime('%Y-%m-%d %H:%M', NEW.start_ts, '-30 minutes')
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'booking overlaps an existing one');
+        END
+    """)
+
+
+def _add_usernames(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS usernames
+        (user_id text PRIMARY KEY, username text, updated_at text NOT NULL)
+    """)
+
+
+def _add_sent_reminders(conn):
+    # One row per reminder that went out, so a reminder is never sent twice,
+    # not even after a restart or by two processes at once
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sent_reminders
+        (booking_id INTEGER NOT NULL, kind text NOT NULL, sent_at text NOT NULL, PRIMARY KEY (booking_id, kind))
+    """)
+
+
+def _add_resources(conn):
+    # Resources are the bookable things of a house. The houses are separate database files,
+    # so within one file the bookings only need to be told apart by resource_id.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS resources
+        (id text PRIMARY KEY, name text NOT NULL)
+    """)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(bookings)")]
+    if 'resource_id' not in columns:
+        conn.execute(f"ALTER TABLE bookings ADD COLUMN resource_id text NOT NULL DEFAULT '{DEFAULT_RESOURCE}'")
+
+    # Conflict checks and free-slot scans only read the rows of one resource
+    conn.execute("DROP INDEX IF EXISTS idx_bookings_start_end")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_resource_start ON bookings (resource_id, start_ts, end_ts)")
+    # Archiving, the reminder reload and the list of all bookings read every resource by start_ts
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_start ON bookings (start_ts)")
+
+    # Bookings of different resources may overlap
+    conn.execute("DROP TRIGGER IF EXISTS bookings_no_overlap")
+    conn.execute("""
+        CREATE TRIGGER bookings_no_overlap
+        BEFORE INSERT ON bookings
+        WHEN EXISTS (
+            SELECT 1 FROM bookings
+            WHERE resource_id = NEW.resource_id
+              AND start_ts >= strftime('%Y-%m-%d %H:%M', NEW.start_ts, '-30 minutes', '-1 day')
+              AND start_ts < strftime('%Y-%m-%d %H:%M', NEW.end_ts, '+30 minutes')
+              AND end_ts > strftime('%Y-%m-%d %H:%M', NEW.start_ts, '-30 minutes')
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'booking overlaps an existing one');
+        END
+    """)
+
+
+def _add_sessions(conn):
+    # Conversation state (context.user_data) as compact JSON, shared by all bot processes
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions
+        (user_id INTEGER PRIMARY KEY, data text NOT NULL, updated_at text NOT NULL)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions (updated_at)")
+
+
+def _add_bookings_archive(conn):
+    # Bookings past their house's retention, moved here by the retention job in batches.
+    # Each row is one batch: a zlib-compressed JSON list of [id, user_id, resource_id, start_ts, end_ts].
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bookings_archive
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, first_start_ts text NOT NULL, last_start_ts text NOT NULL,
+         count INTEGER NOT NULL, data BLOB NOT NULL)
+    """)
+
+
+def _add_usage(conn):
+    # Running aggregates for the analytics, kept up to date in the same transaction as every
+    # booking and cancellation. Archiving doesn't touch them, so they cover the whole history.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS usage_hourly
+        (resource_id text NOT NULL, hour_ts text NOT NULL, minutes INTEGER NOT NULL,
+         PRIMARY KEY (resource_id, hour_ts)) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS usage_daily
+        (resource_id text NOT NULL, day text NOT NULL, booked INTEGER NOT NULL, cancelled INTEGER NOT NULL,
+         PRIMARY KEY (resource_id, day)) WITHOUT ROWID
+    """)
+
+    # Backfill from the bookings and the archive, cancellations weren't recorded before
+    bookings = conn.execute("SELECT resource_id, start_ts, end_ts FROM bookings WHERE start_ts IS NOT NULL").fetchall()
+    for data, in conn.execute("SELECT data FROM bookings_archive"):
+        bookings.extend((resource_id, start_ts, end_ts)
+                        for _, _, resource_id, start_ts, end_ts in json.loads(zlib.decompress(data)))
+    hourly, daily = {}, {}
+    for resource_id, start_ts, end_ts in bookings:
+        start, end = from_ts(start_ts), from_ts(end_ts)
+        for hour, minutes in split_by_hour(start, end):
+            key = (resource_id, to_ts(hour))
+            hourly[key] = hourly.get(key, 0) + minutes
+        key = (resource_id, start.date().isoformat())
+        daily[key] = daily.get(key, 0) + 1
+    conn.executemany("INSERT INTO usage_hourly VALUES (?, ?, ?)", [key + (minutes,) for key, minutes in hourly.items()])
+    conn.executemany("INSERT INTO usage_daily VALUES (?, ?, ?, 0)", [key + (booked,) for key, booked in daily.items()])
+
+
+def _add_booking_rules(conn):
+    # Weekly repeats of a booking. The occurrences are ordinary rows in bookings that point
+    # back to their rule, so the reminders, the free slots and the retention treat them like
+    # any other booking. A rule is dropped once its last occurrence was archived.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS booking_rules
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id text NOT NULL, resource_id text NOT NULL,
+         first_start_ts text NOT NULL, last_start_ts text NOT NULL, interval_days INTEGER NOT NULL,
+         count INTEGER NOT NULL, created_at text NOT NULL)
+    """)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(bookings)")]
+    if 'rule_id' not in columns:
+        conn.execute("ALTER TABLE bookings ADD COLUMN rule_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_rule ON bookings (rule_id) WHERE rule_id IS NOT NULL")
+
+
+def _add_waitlist(conn):
+    # Users waiting for a taken time to become free, matched against every cancellation by the
+    # interval index. held_until is set while a freed time is held for the user.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS waitlist
+        (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id text NOT NULL, resource_id text NOT NULL,
+         start_ts text NOT NULL, end_ts text NOT NULL, created_at text NOT NULL, held_until text,
+         UNIQUE (user_id, resource_id, start_ts, end_ts))
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_resource_start ON waitlist (resource_id, start_ts, end_ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_held ON waitlist (held_until) WHERE held_until IS NOT NULL")
+
+
+def _add_start_index(conn):
+    # Keyset pagination of the list of all bookings by (start_ts, id), the index holds the rowid.
+    # _add_resources creates it too, this is for the databases it migrated before it did
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_start ON bookings (start_ts)")
+
+
+def _add_span_trigger(conn):
+    # bookings_no_overlap only looks one day (MAX_BOOKING_SPAN) back, so a longer booking could hide
+    # an overlap from it. Empty, inverted and longer bookings are rejected from any writer.
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS bookings_valid_span
+        BEFORE INSERT ON bookings
+        WHEN NEW.end_ts <= NEW.start_ts OR NEW.end_ts > strftime('%Y-%m-%d %H:%M', NEW.start_ts, '+1 day')
+        BEGIN
+            SELECT RAISE(ABORT, 'booking is empty or longer than a day');
+        END
+    """)
+
+
+# Each entry upgrades the database by one version, the version is tracked in PRAGMA user_version
+MIGRATIONS = [
+    _create_bookings_table,
+    _add_timestamps,
+    _add_overlap_trigger,
+    _add_usernames,
+    _add_sent_reminders,
+    _add_resources,
+    _add_sessions,
+    _add_bookings_archive,
+    _add_usage,
+    _add_booking_rules,
+    _add_waitlist,
+    _add_start_index,
+    _add_span_trigger,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn) -> None:
+    """Brings the database schema up to SCHEMA_VERSION in place."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    # Take the write lock first so that two processes starting at once don't migrate twice
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("Migrating bookings database to version %s", number)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def enable_incremental_vacuum(conn) -> None:
+    """Switches a database created before auto_vacuum was set to incremental vacuum.
+
+    Takes a full VACUUM, which rewrites the file under the write lock, so run it while the bot is stopped.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    logger.info("Enabling incremental vacuum, rewriting the database")
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+if __name__ == '__main__':
+    from config import DB_PATH
+    from houses import HOUSES
+
+    logging.basicConfig(level=logging.INFO)
+    # Every house has its own database file, DB_PATH also holds the shared tables like usernames
+    for path in dict.fromkeys([DB_PATH] + [house.db_path for house in HOUSES.values()]):
+        conn = sqlite3.connect(path)
+        migrate(conn)
+        enable_incremental_vacuum(conn)
+        conn.close()
@@ -0,0 +1,179 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from telegram.ext import BasePersistence
+
+import repository
+from config import SESSION_FLUSH_SECONDS, SESSION_TTL_HOURS, SESSION_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(data: dict):
+    # Compact and stable, so unchanged data serializes to the same string. Empty sessions aren't stored.
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), sort_keys=True) if data else None
+
+
+class SessionStore(defaultdict):
+    """The dispatcher's user_data, holding at most max_size users.
+
+    A user missing from memory is loaded from the pending writes or the sessions table,
+    the least recently seen users are dropped when the store is full.
+    """
+
+    def __init__(self, persistence: 'SessionPersistence', max_size: int):
+        super().__init__(dict)
+        self.persistence = persistence
+        self.max_size = max_size
+        # Serialized data as last loaded or saved, to skip writes that change nothing
+        self.snapshots = {}
+        self.lock = threading.RLock()
+
+    def __missing__(self, user_id):
+        serialized = self.persistence.load(user_id)
+        with self.lock:
+            if user_id not in self:
+                self.put(user_id, serialized)
+            return dict.__getitem__(self, user_id)
+
+    def put(self, user_id, serialized) -> None:
+        data = json.loads(serialized) if serialized else {}
+        existing = self.pop(user_id, None)
+        if existing is not None:
+            # Handlers may still hold the old dict, so it's updated in place
+            existing.clear()
+            existing.update(data)
+            data = existing
+        # Re-inserting moves the user to the end, the front of the dict are the least recently seen
+        dict.__setitem__(self, user_id, data)
+        self.snapshots[user_id] = serialized
+        while len(self) > self.max_size:
+            oldest = next(iter(self))
+            dict.__delitem__(self, oldest)
+            self.snapshots.pop(oldest, None)
+
+
+class _Unused(defaultdict):
+    # chat_data isn't used, hand out empty dicts without keeping one per chat forever
+    def __init__(self):
+        super().__init__(dict)
+
+    def __missing__(self, key):
+        return {}
+
+
+class SessionPersistence(BasePersistence):
+    """Keeps context.user_data in the sessions table, shared by all bot processes.
+
+    Writes are buffered and flushed in batches every flush_interval by a background thread,
+    and only for users whose data actually changed. Before the handlers run, refresh()
+    reloads the user's session so an update that arrives at another process, or after a
+    restart, continues where the conversation was left. Sessions that weren't changed for
+    ttl are treated as abandoned and start over empty.
+    """
+
+    def __init__(self, flush_interval: float = SESSION_FLUSH_SECONDS,
+                 ttl: timedelta = timedelta(hours=SESSION_TTL_HOURS), cache_size: int = SESSION_CACHE_SIZE):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.user_data = SessionStore(self, cache_size)
+        self._chat_data = _Unused()
+        # Serialized data (None to delete) of the users changed since the last flush
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, name='session-flush', daemon=True)
+        self._thread.start()
+
+    # The sessions only hold strings, there are never Bot instances to swap in or out,
+    # and copying the store would detach it from the dispatcher
+    def insert_bot(self, obj: object) -> object:
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        return obj
+
+    def load(self, user_id):
+        with self._pending_lock:
+            if user_id in self._pending:
+                return self._pending[user_id]
+        return repository.load_session(user_id, datetime.now() - self.ttl)
+
+    def refresh(self, update, context) -> None:
+        """TypeHandler callback that reloads the session of the update's user."""
+        user = update.effective_user
+        if user is None:
+            return
+        with self._pending_lock:
+            # Not flushed yet, so what this process has is the latest
+            if user.id in self._pending:
+                return
+        serialized = repository.load_session(user.id, datetime.now() - self.ttl)
+        with self.user_data.lock:
+            current = dict.get(self.user_data, user.id)
+            # A handler of the previous update is still changing it, its save comes next
+            if current is not None and dumps(current) != self.user_data.snapshots.get(user.id):
+                return
+            self.user_data.put(user.id, serialized)
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return self._chat_data
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str):
+        return {}
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        serialized = dumps(data)
+        with self.user_data.lock:
+            if self.user_data.snapshots.get(user_id) == serialized:
+                return
+            self.user_data.snapshots[user_id] = serialized
+        with self._pending_lock:
+            self._pending[user_id] = serialized
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def _flush_periodically(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self._write()
+            except Exception:
+                logger.exception("Failed to save the sessions, retrying")
+
+    def _write(self) -> None:
+        with self._flush_lock:
+            with self._pending_lock:
+                batch = self._pending.copy()
+            if not batch:
+                return
+            repository.save_sessions(batch, datetime.now())
+            with self._pending_lock:
+                # Users changed again while the batch was written stay pending
+                for user_id, serialized in batch.items():
+                    if self._pending.get(user_id, serialized) is serialized:
+                        self._pending.pop(user_id, None)
+
+    def flush(self) -> None:
+        """Writes the pending sessions and stops the background thread, called on shutdown."""
+        self._stopped.set()
+        self._thread.join()
+        self._write()
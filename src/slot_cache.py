@@ -0,0 +1,203 @@
+import bisect
+import threading
+from collections import OrderedDict
+from datetime import datetime, date, time, timedelta
+from math import floor, ceil
+from time import monotonic
+
+import repository
+from config import FREE_SLOT_CACHE_DAYS, FREE_SLOT_CACHE_SECONDS
+from schema import from_ts
+
+# Gap kept free before and after every booking
+BUFFER = timedelta(minutes=30)
+# The free slots of a day are shown for the day itself plus 4 hours into the next one
+EXTENDED_DAY = timedelta(days=1, hours=4)
+# Suggested start times are rounded up to this and spread this far apart
+SUGGESTION_GRID = timedelta(minutes=15)
+SUGGESTION_STEP = timedelta(hours=1)
+
+
+def day_window(day: date):
+    start_of_day = datetime.combine(day, time())
+    return start_of_day, start_of_day + EXTENDED_DAY
+
+
+def load_bookings(house_id: str, resource_id: str, day: date):
+    start_of_day, end_of_extended_day = day_window(day)
+    return [(from_ts(start_ts), from_ts(end_ts)) for start_ts, end_ts
+            in repository.bookings_in_window(house_id, resource_id, start_of_day, end_of_extended_day, BUFFER)]
+
+
+def free_time_slots(bookings, start_of_day: datetime, end_of_extended_day: datetime):
+    # List to keep track of free time slots
+    free_time_slots = []
+
+    # Start of the day
+    current_time = start_of_day
+
+    # Loop through the booked time slots, they are sorted by start time
+    for start, end in bookings:
+        start_time_dt = start - BUFFER
+        end_time_dt = end + BUFFER
+
+        # Check if there is a free slot before this booking
+        if (start_time_dt - current_time).total_seconds() > 0:
+            free_time_slots.append((current_time, start_time_dt - timedelta(minutes=1)))
+
+        # Update the current_time to the end of this booking
+        current_time = max(current_time, end_time_dt + timedelta(minutes=1))  # 1-minute cooldown period
+
+    # Check for free time slot between the last booking and 04:00 of the next day
+    if (end_of_extended_day - current_time).total_seconds() > 0:
+        free_time_slots.append((current_time, end_of_extended_day))
+
+    return free_time_slots
+
+
+def render_free_time_slots(free_time_slots) -> str:
+    if not free_time_slots:
+        return "В этот день все занято, выбери другой день для стирки"
+
+    message_text = "Свободное время в выбранный день + 4 часа после:\n"
+    for start, end in free_time_slots:
+        # Rounding start_time for display
+        start_time_minute = floor(start.minute / 5) * 5
+        start_time = f"{start.hour:02d}:{start_time_minute:02d}"
+
+        # Rounding end_time for display
+        end_time_hour, end_time_minute = end.hour, ceil(end.minute / 5) * 5
+        if end_time_minute == 60:
+            end_time_hour += 1
+            end_time_minute = 0
+        end_time = f"{end_time_hour:02d}:{end_time_minute:02d}"
+
+        message_text += f"{start:%d.%m.%Y} - {end:%d.%m.%Y}        {start_time} - {end_time}\n"
+    return message_text
+
+
+def suggest_start_times(bookings, day: date, duration: timedelta, window_start: datetime, window_end: datetime,
+                        not_before: datetime, limit: int):
+    """Earliest start times in [window_start, window_end) at which a booking of duration fits.
+
+    bookings are sorted by start and don't overlap, so the gap around window_start is found
+    with a binary search and only the gaps inside the window are walked from there. A booking
+    fits into the gap between two others if it keeps BUFFER from both, and it never runs past
+    the end of the extended day (04:00 of the next day), whose bookings aren't known here.
+    Start times are on a SUGGESTION_GRID and at least SUGGESTION_STEP apart within a gap.
+    """
+    start_of_day, end_of_extended_day = day_window(day)
+    earliest = max(window_start, start_of_day, not_before)
+    index = bisect.bisect_left(bookings, (earliest,))
+    gap_start = earliest if index == 0 else max(earliest, bookings[index - 1][1] + BUFFER)
+
+    suggestions = []
+    while len(suggestions) < limit and gap_start < window_end:
+        gap_end = min(bookings[index][0] - BUFFER if index < len(bookings) else end_of_extended_day, end_of_extended_day)
+        start = _round_up(gap_start, SUGGESTION_GRID)
+        while start < window_end and start + duration <= gap_end and len(suggestions) < limit:
+            suggestions.append(start)
+            start += SUGGESTION_STEP
+        if index >= len(bookings):
+            break
+        gap_start = max(gap_start, bookings[index][1] + BUFFER)
+        index += 1
+    return suggestions
+
+
+def _round_up(moment: datetime, grid: timedelta) -> datetime:
+    since_midnight = moment - datetime.combine(moment.date(), time())
+    return moment + (-since_midnight) % grid
+
+
+class _Day:
+    __slots__ = ('bookings', 'free_time_slots', 'message', 'loaded_at')
+
+    def __init__(self, day: date, bookings):
+        self.bookings = bookings
+        self.loaded_at = monotonic()
+        self.refresh(day)
+
+    def refresh(self, day: date) -> None:
+        self.free_time_slots = free_time_slots(self.bookings, *day_window(day))
+        self.message = render_free_time_slots(self.free_time_slots)
+
+
+class FreeSlotCache:
+    """LRU cache of the bookings, free slots and rendered message of recently viewed days.
+
+    Entries are keyed by (house_id, resource_id, day). New and cancelled bookings are applied
+    to the cached days they touch in memory, so a date button is answered without a database
+    round trip once its day is cached. Other bot processes don't tell this one about their
+    bookings, so a day is loaded again once it is max_age seconds old.
+    """
+
+    def __init__(self, max_days: int = FREE_SLOT_CACHE_DAYS, max_age: float = FREE_SLOT_CACHE_SECONDS):
+        self.max_days = max_days
+        self.max_age = max_age
+        self._days = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every change, so that a day loaded concurrently with a change isn't cached stale
+        self._version = 0
+
+    def _get(self, house_id: str, resource_id: str, day: date) -> _Day:
+        key = (house_id, resource_id, day)
+        with self._lock:
+            entry = self._days.get(key)
+            if entry is not None and monotonic() - entry.loaded_at < self.max_age:
+                self._days.move_to_end(key)
+                return entry
+            version = self._version
+
+        entry = _Day(day, load_bookings(house_id, resource_id, day))
+
+        with self._lock:
+            if version == self._version:
+                self._days[key] = entry
+                self._days.move_to_end(key)
+                while len(self._days) > self.max_days:
+                    self._days.popitem(last=False)
+        return entry
+
+    def free_time_slots(self, house_id: str, resource_id: str, day: date):
+        return self._get(house_id, resource_id, day).free_time_slots
+
+    def message(self, house_id: str, resource_id: str, day: date) -> str:
+        return self._get(house_id, resource_id, day).message
+
+    def suggest_start_times(self, house_id: str, resource_id: str, day: date, duration: timedelta,
+                            window_start: datetime, window_end: datetime, not_before: datetime, limit: int):
+        entry = self._get(house_id, resource_id, day)
+        # Under the lock, so a concurrent add_booking can't shift the list mid-search
+        with self._lock:
+            return suggest_start_times(entry.bookings, day, duration, window_start, window_end, not_before, limit)
+
+    def _affected_days(self, start: datetime, end: datetime):
+        # Days whose window intersects the buffered booking, mirrors the bookings_in_window query
+        day = (start - BUFFER - EXTENDED_DAY).date()
+        while day <= (end + BUFFER).date():
+            start_of_day, end_of_extended_day = day_window(day)
+            if start < end_of_extended_day + BUFFER and end > start_of_day - BUFFER:
+                yield day
+            day += timedelta(days=1)
+
+    def add_booking(self, house_id: str, resource_id: str, start: datetime, end: datetime) -> None:
+        with self._lock:
+            self._version += 1
+            for day in self._affected_days(start, end):
+                entry = self._days.get((house_id, resource_id, day))
+                if entry is not None:
+                    bisect.insort(entry.bookings, (start, end))
+                    entry.refresh(day)
+
+    def remove_booking(self, house_id: str, resource_id: str, start: datetime, end: datetime) -> None:
+        with self._lock:
+            self._version += 1
+            for day in self._affected_days(start, end):
+                entry = self._days.get((house_id, resource_id, day))
+                if entry is not None and (start, end) in entry.bookings:
+                    entry.bookings.remove((start, end))
+                    entry.refresh(day)
+
+
+free_slot_cache = FreeSlotCache()
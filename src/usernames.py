@@ -0,0 +1,137 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import repository
+from config import BOT_TOKEN, TELEGRAM_API_URL, TELEGRAM_API_TIMEOUT, USERNAME_TTL_HOURS
+from metrics import TELEGRAM_SECONDS
+
+logger = logging.getLogger(__name__)
+
+USERNAME_TTL = timedelta(hours=USERNAME_TTL_HOURS)
+
+# One keep-alive session for all getChat lookups instead of a new connection per request.
+# Made on the first lookup, so requests isn't imported while the bot starts
+_session = None
+_session_lock = threading.Lock()
+
+# Runs the getChat lookups. The background refreshes wait for their lookups on their own
+# executor, if they ran on this one they could take all of its workers and wait forever
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='usernames')
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='usernames-refresh')
+
+# get_username's result when the lookup itself failed, unlike None for a user without a username
+LOOKUP_FAILED = object()
+
+# user_ids whose refresh is already queued, so a popular user isn't looked up twice at once
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Last username written per user_id, to skip the DB write when nothing changed
+_seen = {}
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=8))
+            _session = session
+    return _session
+
+
+def get_username(user_id):
+    """Returns the user's username, None if they have none, LOOKUP_FAILED if getChat failed."""
+    import requests
+    session = _get_session()
+    try:
+        with TELEGRAM_SECONDS.time('getChat'):
+            response = session.get(f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getChat",
+                                   params={'chat_id': user_id}, timeout=TELEGRAM_API_TIMEOUT)
+        data = response.json()
+    except (requests.RequestException, ValueError):
+        logger.warning("getChat failed for %s", user_id, exc_info=True)
+        return LOOKUP_FAILED
+    if not data.get("ok"):
+        return LOOKUP_FAILED
+    return data["result"].get("username")
+
+
+def _fetch(user_ids, previous=None):
+    """Looks the users up and stores the result, previous is {user_id: username} known before.
+
+    Users without a username are stored too, as None, so they aren't looked up again until the
+    TTL runs out. When the lookup fails the previous username, if any, is kept for another TTL.
+    """
+    previous = previous or {}
+    usernames = {}
+    for user_id, username in zip(user_ids, executor.map(get_username, user_ids)):
+        usernames[user_id] = previous.get(user_id) if username is LOOKUP_FAILED else username
+    repository.save_usernames(usernames, datetime.now())
+    return usernames
+
+
+def _refresh_in_background(previous) -> None:
+    # previous is {user_id: username} of the expired entries
+    with _refreshing_lock:
+        user_ids = [user_id for user_id in previous if user_id not in _refreshing]
+        _refreshing.update(user_ids)
+    if not user_ids:
+        return
+
+    def refresh():
+        try:
+            _fetch(user_ids, previous)
+        except Exception:
+            logger.exception("Failed to refresh usernames")
+        finally:
+            with _refreshing_lock:
+                _refreshing.difference_update(user_ids)
+
+    refresh_executor.submit(refresh)
+
+
+def get_usernames(user_ids):
+    """Returns {user_id: username or None} for the given user_ids.
+
+    Names come from the usernames table, including the users known to have none. Only users
+    that were never seen are looked up synchronously; expired entries are returned as they are
+    and refreshed in the background.
+    """
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    cached = repository.cached_usernames(user_ids)
+
+    now = datetime.now()
+    usernames = {user_id: username for user_id, (username, _) in cached.items()}
+    stale = {user_id: username for user_id, (username, updated_at) in cached.items() if now - updated_at > USERNAME_TTL}
+    missing = [user_id for user_id in user_ids if user_id not in cached]
+
+    if stale:
+        _refresh_in_background(stale)
+    if missing:
+        usernames.update(_fetch(missing))
+    return usernames
+
+
+def remember_user(update: Update, context: CallbackContext) -> None:
+    # Runs before the other handlers for every update, keeping the names fresh without any lookups
+    user = update.effective_user
+    if user is None or user.username is None:
+        return
+
+    user_id = str(user.id)
+    now = datetime.now()
+    seen = _seen.get(user_id)
+    if seen is not None and seen[0] == user.username and now - seen[1] < USERNAME_TTL / 2:
+        return
+
+    _seen[user_id] = (user.username, now)
+    repository.save_usernames({user_id: user.username}, now)
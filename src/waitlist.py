@@ -0,0 +1,84 @@
+import logging
+from datetime import datetime, timedelta
+
+from apscheduler.jobstores.base import JobLookupError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import repository
+from config import WAITLIST_HOLD_MINUTES
+from houses import HOUSES, label
+from slot_cache import BUFFER
+
+logger = logging.getLogger(__name__)
+
+
+class Waitlist:
+    """Tells the users waiting for a taken time as soon as a cancellation frees it.
+
+    Every cancellation is matched against the waitlist through its interval index. The first
+    waiter (in the order they subscribed) whose time is now free gets it held for the hold
+    period and a message with a button to book it. Nobody else can book a held time, and when
+    a hold runs out unclaimed the time is offered to the next waiter. Holds survive restarts,
+    their expiry jobs are armed again on start.
+    """
+
+    def __init__(self, scheduler, hold: timedelta = timedelta(minutes=WAITLIST_HOLD_MINUTES)):
+        self.scheduler = scheduler
+        self.hold = hold
+        self.sender = None
+
+    def start(self, sender) -> None:
+        # sender is anything with Bot.send_message's signature, normally the Outbox
+        self.sender = sender
+        for house_id in HOUSES:
+            for waiter_id, held_until in repository.held_waiters(house_id):
+                self._arm(house_id, waiter_id, held_until)
+
+    def subscribe(self, house_id: str, resource_id: str, user_id, start: datetime, end: datetime) -> bool:
+        return repository.add_waiter(house_id, resource_id, user_id, start, end, datetime.now())
+
+    def slot_freed(self, house_id: str, resource_id: str, start: datetime, end: datetime) -> None:
+        now = datetime.now()
+        held_until = now + self.hold
+        for waiter_id, user_id, wanted_start, wanted_end in repository.hold_freed(
+                house_id, resource_id, start, end, BUFFER, now, held_until):
+            keyboard = [[InlineKeyboardButton("Забронировать", callback_data=f'waitbook_{house_id}_{waiter_id}')]]
+            self.sender.send_message(
+                chat_id=user_id,
+                text=f"Освободилось время с {wanted_start:%d.%m.%Y %H:%M} до {wanted_end:%d.%m.%Y %H:%M}{label(house_id, resource_id)}, "
+                     f"которое ты ждешь. Оно занято за тобой до {held_until:%H:%M}",
+                reply_markup=InlineKeyboardMarkup(keyboard))
+            self._arm(house_id, waiter_id, held_until)
+
+    def claim(self, house_id: str, waiter_id, user_id):
+        """Returns (resource_id, start, end) the user may book now, None if the offer is gone."""
+        entry = repository.waiter(house_id, waiter_id)
+        if entry is None or str(entry[0]) != str(user_id):
+            return None
+        return entry[1:4]
+
+    def done(self, house_id: str, waiter_id) -> None:
+        # The user booked or tried to book their time, either way they stop waiting
+        repository.delete_waiter(house_id, waiter_id)
+        try:
+            self.scheduler.remove_job(self._job_id(house_id, waiter_id))
+        except JobLookupError:
+            pass
+
+    @staticmethod
+    def _job_id(house_id: str, waiter_id) -> str:
+        return f'waitlist_{house_id}_{waiter_id}'
+
+    def _arm(self, house_id: str, waiter_id, held_until: datetime) -> None:
+        self.scheduler.add_job(self._expire, 'date', run_date=max(held_until, datetime.now()), args=(house_id, waiter_id),
+                               id=self._job_id(house_id, waiter_id), replace_existing=True, misfire_grace_time=None)
+
+    def _expire(self, house_id: str, waiter_id) -> None:
+        freed = repository.release_expired_hold(house_id, waiter_id, datetime.now())
+        if freed is None:
+            return
+        logger.info("Hold of waiter %s/%s ran out", house_id, waiter_id)
+        try:
+            self.slot_freed(house_id, *freed)
+        except Exception:
+            logger.exception("Failed to offer the time of waiter %s/%s to the next one", house_id, waiter_id)
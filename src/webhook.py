@@ -0,0 +1,143 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from telegram import Update
+
+from config import (WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Embedded HTTP server that receives the updates Telegram posts to the webhook.
+
+    Requests are validated against the secret token and the updates are put on a bounded
+    queue, so the HTTP threads answer right away. A pool of worker threads passes them to
+    the dispatcher. When the queue is full the server answers 503 and Telegram redelivers
+    the update later, which keeps a burst from piling up in memory.
+    """
+
+    def __init__(self, dispatcher, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, secret_token: str = WEBHOOK_SECRET,
+                 workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret_token = secret_token
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.metrics = Counter()
+        self._metrics_lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, name=f'webhook-worker-{number}', daemon=True)
+                         for number in range(workers)]
+        self._server_thread = None
+
+        if not secret_token:
+            logger.warning("WEBHOOK_SECRET is not set, anybody who knows the URL can post updates")
+
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self._answer(webhook.receive(self.path, self.headers, self._body()))
+
+            def do_GET(self):
+                self._answer(405)
+
+            def _body(self) -> bytes:
+                length = int(self.headers.get('Content-Length', 0))
+                return self.rfile.read(length) if length else b''
+
+            def _answer(self, status: int) -> None:
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self.server = Server((listen, port), Handler)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def _count(self, name: str) -> None:
+        with self._metrics_lock:
+            self.metrics[name] += 1
+
+    def receive(self, path: str, headers, body: bytes) -> int:
+        """Validates and queues one posted update, returns the HTTP status to answer with."""
+        if path != self.path:
+            return 404
+        if self.secret_token and not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            self._count('rejected')
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self._count('rejected')
+            return 400
+        # Telegram only posts JSON objects, anything else would fail in the workers
+        if not isinstance(data, dict):
+            self._count('rejected')
+            return 400
+        try:
+            self.updates.put_nowait(data)
+        except queue.Full:
+            self._count('refused')
+            return 503
+        self._count('received')
+        return 200
+
+    def _work(self) -> None:
+        # Nothing may raise out of this loop, a worker that dies is never replaced
+        while True:
+            data = self.updates.get()
+            if data is None:
+                return
+            try:
+                self.dispatcher.process_update(Update.de_json(data, self.dispatcher.bot))
+                self._count('processed')
+            except Exception:
+                self._count('failed')
+                update_id = data.get('update_id') if isinstance(data, dict) else None
+                logger.exception("Failed to process update %s", update_id)
+
+    def set_webhook(self, url: str) -> None:
+        api_kwargs = {'secret_token': self.secret_token} if self.secret_token else None
+        self.dispatcher.bot.set_webhook(url=url.rstrip('/') + self.path, max_connections=len(self._workers) * 5,
+                                        api_kwargs=api_kwargs)
+
+    def start(self) -> None:
+        # The dispatcher's own thread isn't fed by us, but starting it runs the pool of
+        # run_async handlers and the error handling that come with it
+        if not self.dispatcher.running:
+            threading.Thread(target=self.dispatcher.start, name='dispatcher', daemon=True).start()
+        for worker in self._workers:
+            worker.start()
+        self._server_thread = threading.Thread(target=self.server.serve_forever, name='webhook-server', daemon=True)
+        self._server_thread.start()
+        logger.info("Webhook server listening on port %s", self.port)
+
+    def stop(self) -> None:
+        # Stops accepting updates, then lets the workers finish the queued ones
+        self.server.shutdown()
+        self.server.server_close()
+        for _ in self._workers:
+            self.updates.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.dispatcher.stop()